@@ -0,0 +1,528 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+WinNet - Sync Benchmark
+Generates a synthetic x-ui.db and runs the client / tunnel sync cycles
+against it with configurable churn, reporting cycle latency percentiles,
+rows written, time spent holding the write lock, GC pauses and peak RSS.
+
+    python3 bench_sync.py --inbounds 20 --clients 2000 --span 3 --cycles 50
+
+With --panels N, N databases sharing the same subIds are generated and
+synced together through sync_panels(). --verify-sql runs the Python and the SQL
+engine of every selected engine side by side on two copies of the database
+under the same churn and clock, and fails on the first cycle where they
+disagree. It also checks the pipelined loop, with every snapshot read while
+the previous write is still pending, against sync_once(), and with both
+engines selected a sync_supervisor worker cycle against the standalone
+sync_once() of each engine.
+
+--verify-sql is the regression gate of the SQL engines (sync_once_sql() and
+the set-based tunnel cycle) and of the pipelined and supervised cycles: run it
+after changing any of them, it exits with status 1 when a cycle differs or
+raises:
+
+    python3 bench_sync.py --verify-sql --seeds 5
+"""
+from __future__ import annotations
+import sqlite3, json, argparse, os, shutil, time, random, resource, io, contextlib, gc, tracemalloc, functools, queue, threading, types
+from concurrent.futures import ThreadPoolExecutor
+
+import sync_xui_sqlite
+import sync_inbound_tunnel
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS inbounds(
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  user_id INTEGER DEFAULT 1,
+  up INTEGER DEFAULT 0,
+  down INTEGER DEFAULT 0,
+  total INTEGER DEFAULT 0,
+  remark TEXT,
+  enable NUMERIC DEFAULT 1,
+  expiry_time INTEGER DEFAULT 0,
+  listen TEXT DEFAULT '',
+  port INTEGER,
+  protocol TEXT,
+  settings TEXT,
+  stream_settings TEXT DEFAULT '{}',
+  tag TEXT,
+  sniffing TEXT DEFAULT '{}'
+);
+CREATE TABLE IF NOT EXISTS client_traffics(
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  inbound_id INTEGER,
+  enable NUMERIC DEFAULT 1,
+  email TEXT UNIQUE,
+  up INTEGER DEFAULT 0,
+  down INTEGER DEFAULT 0,
+  expiry_time INTEGER DEFAULT 0,
+  total INTEGER DEFAULT 0,
+  reset INTEGER DEFAULT 0
+);
+"""
+
+CHURN_KINDS = ("growth", "reset", "expiry")
+GB = 1024 * 1024 * 1024
+
+
+def generate_db(path, inbounds=10, clients=200, span=2, tunnels=4, mult_ratio=0.25,
+                shared_uuid_ratio=0.05, seed=1):
+    """Create a fresh x-ui.db with subscriptions spread over several inbounds.
+
+    Every subscription gets one client (same UUID) on `span` random inbounds,
+    so each inbound ends up with roughly `clients` clients. A share of the
+    copies has no subId and must be linked by UUID. `tunnels` groups of two
+    tunnel inbounds with equal remarks are added as well.
+    """
+    rng = random.Random(seed)
+    if os.path.exists(path):
+        os.remove(path)
+    conn = sqlite3.connect(path)
+    conn.executescript(SCHEMA)
+    span = max(1, min(span, inbounds))
+    inb_clients = [[] for _ in range(inbounds)]
+    now_ms = int(time.time() * 1000)
+    n_subs = max(1, inbounds * clients // span)
+    seq = 0
+    for s in range(n_subs):
+        uuid = "%08x-0000-4000-8000-%012x" % (rng.getrandbits(32), s)
+        quota = rng.choice((0, 10, 30, 50, 100))
+        expiry = rng.choice((0, now_ms + rng.randint(1, 60) * 86400000))
+        for j, idx in enumerate(rng.sample(range(inbounds), span)):
+            seq += 1
+            linked = j == 0 or rng.random() >= shared_uuid_ratio
+            inb_clients[idx].append({
+                "id": uuid, "flow": "", "email": f"u{seq}", "limitIp": 0,
+                "totalGB": quota, "expiryTime": expiry, "enable": True,
+                "tgId": "", "subId": f"s{s:06d}" if linked else "", "comment": "",
+                "reset": 0, "created_at": now_ms, "updated_at": now_ms,
+            })
+    cur = conn.cursor()
+    for i, cls in enumerate(inb_clients):
+        remark = f"inbound-{i}"
+        if rng.random() < mult_ratio:
+            remark += rng.choice((" [x0.5]", " [x2]", " [x1.5]"))
+        settings = {"clients": cls, "decryption": "none", "fallbacks": []}
+        cur.execute("INSERT INTO inbounds(remark, port, protocol, settings, tag) VALUES(?,?,?,?,?)",
+                    (remark, 10000 + i, "vless", json.dumps(settings), f"inbound-{10000 + i}"))
+        iid = cur.lastrowid
+        cur.executemany(
+            "INSERT INTO client_traffics(inbound_id, enable, email, up, down, expiry_time, total, reset) "
+            "VALUES(?,?,?,?,?,?,?,0)",
+            [(iid, 1, c["email"], 0, 0, c["expiryTime"], c["totalGB"] * GB) for c in cls])
+    for g in range(tunnels):
+        for r in range(2):
+            cur.execute("INSERT INTO inbounds(remark, port, protocol, settings, tag, up, down) VALUES(?,?,?,?,?,?,?)",
+                        (f"tunnel-{g}", 20000 + 2 * g + r, rng.choice(("tunnel", "tun")), "{}",
+                         f"tunnel-{g}-{r}", rng.randint(0, GB), rng.randint(0, GB)))
+    conn.commit()
+    conn.close()
+    return n_subs
+
+
+def churn(path, rng, kinds, rate):
+    """Mutate the DB the way x-ui would between two sync cycles.
+
+    growth: traffic grows on a `rate` share of client rows and tunnels.
+    reset:  a few client rows have up/down zeroed by the panel.
+    expiry: a few clients get a new expiryTime / totalGB in settings.
+    """
+    conn = sqlite3.connect(path, timeout=60)
+    cur = conn.cursor()
+    ids = [r[0] for r in cur.execute("SELECT id FROM client_traffics")]
+    n = max(1, int(len(ids) * rate))
+    if "growth" in kinds and ids:
+        cur.executemany("UPDATE client_traffics SET up = up + ?, down = down + ? WHERE id = ?",
+                        [(rng.randint(0, 50 << 20), rng.randint(0, 500 << 20), i)
+                         for i in rng.sample(ids, min(n, len(ids)))])
+        tun = [r[0] for r in cur.execute("SELECT id FROM inbounds WHERE protocol IN ('tunnel', 'tun')")]
+        cur.executemany("UPDATE inbounds SET up = up + ?, down = down + ? WHERE id = ?",
+                        [(rng.randint(0, 1 << 20), rng.randint(0, 10 << 20), i) for i in tun])
+    if "reset" in kinds and ids:
+        cur.executemany("UPDATE client_traffics SET up = 0, down = 0 WHERE id = ?",
+                        [(i,) for i in rng.sample(ids, min(max(1, n // 20), len(ids)))])
+        tun = [r[0] for r in cur.execute("SELECT id FROM inbounds WHERE protocol IN ('tunnel', 'tun')")]
+        if tun and rng.random() < 0.3:
+            cur.execute("UPDATE inbounds SET up = 0, down = 0 WHERE id = ?", (rng.choice(tun),))
+    if "expiry" in kinds:
+        rows = cur.execute("SELECT id, settings FROM inbounds WHERE protocol = 'vless'").fetchall()
+        now_ms = int(time.time() * 1000)
+        for iid, raw in rng.sample(rows, min(2, len(rows))):
+            s = json.loads(raw)
+            cls = s.get("clients", [])
+            for c in rng.sample(cls, min(max(1, n // 20), len(cls))):
+                c["expiryTime"] = now_ms + rng.randint(1, 90) * 86400000
+                c["totalGB"] = rng.choice((10, 30, 50, 100))
+                c["updated_at"] = now_ms
+            cur.execute("UPDATE inbounds SET settings = ? WHERE id = ?", (json.dumps(s), iid))
+        tun = [r[0] for r in cur.execute("SELECT id FROM inbounds WHERE protocol IN ('tunnel', 'tun')")]
+        if tun and rng.random() < 0.3:
+            cur.execute("UPDATE inbounds SET expiry_time = ?, total = ? WHERE id = ?",
+                        (now_ms + rng.randint(1, 90) * 86400000, rng.choice((0, 100, 500)) * GB, rng.choice(tun)))
+    conn.commit()
+    conn.close()
+
+
+class LockTimer:
+    """Measures time between the first write statement and COMMIT/ROLLBACK
+    on a connection, i.e. how long we hold SQLite's write lock."""
+
+    def __init__(self, conn):
+        self.start = None
+        self.total = 0.0
+        conn.set_trace_callback(self.trace)
+
+    def trace(self, sql):
+        head = sql.lstrip()[:8].upper()
+        if self.start is None and head.startswith(("INSERT", "UPDATE", "DELETE", "REPLACE", "BEGIN IM")):
+            self.start = time.perf_counter()
+        elif self.start is not None and head.startswith(("COMMIT", "ROLLBACK")):
+            self.total += time.perf_counter() - self.start
+            self.start = None
+
+
+class GcTimer:
+    """Sums the time the cyclic garbage collector spends in collections."""
+
+    def __init__(self):
+        self.start = None
+        self.total = 0.0
+        self.worst = 0.0
+        gc.callbacks.append(self.callback)
+
+    def callback(self, phase, info):
+        if phase == "start":
+            self.start = time.perf_counter()
+        elif self.start is not None:
+            pause = time.perf_counter() - self.start
+            self.total += pause
+            self.worst = max(self.worst, pause)
+            self.start = None
+
+    def close(self):
+        gc.callbacks.remove(self.callback)
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    v = sorted(values)
+    return v[min(len(v) - 1, int(round(q / 100.0 * (len(v) - 1))))]
+
+
+def report(name, lat, rows, lock):
+    ms = [x * 1000 for x in lat]
+    print(f"[BENCH] {name:<8} cycles={len(ms)} "
+          f"p50={percentile(ms, 50):.1f}ms p90={percentile(ms, 90):.1f}ms "
+          f"p99={percentile(ms, 99):.1f}ms max={max(ms or [0]):.1f}ms "
+          f"rows_written={sum(rows)} write_lock={sum(lock) * 1000:.1f}ms "
+          f"(max {max(lock or [0]) * 1000:.1f}ms)")
+
+
+def run_bench(path, engines, cycles, kinds, rate, unified=False, stateless=False, seed=1, debug=False,
+              trace_mem=False, sql=False, plan_workers=0):
+    """Run `cycles` churn + sync rounds; returns {engine: (latencies, rows, lock)}"""
+    rng = random.Random(seed + 1)
+    mods = {"client": sync_xui_sqlite, "tunnel": sync_inbound_tunnel}
+    names = ["+".join(engines)] if unified else list(engines)
+    conns = {n: sqlite3.connect(path, timeout=60, check_same_thread=False) for n in names}
+    for c in conns.values():
+        c.execute("PRAGMA busy_timeout = 3000")
+    timers = {n: LockTimer(c) for n, c in conns.items()}
+    states = {n: {} for n in names}
+    with contextlib.redirect_stdout(io.StringIO()):
+        for e in engines:
+            mods[e].ensure_seed(conns[names[0]])
+    planner = functools.partial(sync_xui_sqlite.plan_sharded, shards=plan_workers) if plan_workers > 1 else None
+    gct = GcTimer()
+    if trace_mem:
+        tracemalloc.start()
+    stats = {n: ([], [], []) for n in names}
+    for _ in range(cycles):
+        if kinds:
+            churn(path, rng, kinds, rate)
+        for n in names:
+            conn = conns[n]
+            st = None if stateless else states[n]
+            before_rows = conn.total_changes
+            before_lock = timers[n].total
+            out = io.StringIO()
+            t0 = time.perf_counter()
+            with contextlib.redirect_stdout(out):
+                if unified:
+                    sync_xui_sqlite.run_engines(conn, engines, apply=True, states=st)
+                elif sql and n == "client":
+                    sync_xui_sqlite.sync_once_sql(conn, apply=True, state=st, planner=planner)
+                elif n == "client":
+                    sync_xui_sqlite.sync_once(conn, apply=True, state=st, planner=planner)
+                else:
+                    mods[n].sync_once(conn, apply=True, state=st)
+            stats[n][0].append(time.perf_counter() - t0)
+            stats[n][1].append(conn.total_changes - before_rows)
+            stats[n][2].append(timers[n].total - before_lock)
+            if debug:
+                print(out.getvalue(), end="")
+    gct.close()
+    if trace_mem:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"[BENCH] py_heap_peak={peak >> 20}MiB")
+    print(f"[BENCH] gc_pause={gct.total * 1000:.1f}ms (max {gct.worst * 1000:.1f}ms)")
+    for c in conns.values():
+        c.close()
+    return stats
+
+
+def run_panels_bench(paths, cycles, kinds, rate, stateless=False, seed=1, debug=False):
+    """Like run_bench for the client engine over several panel databases"""
+    rng = random.Random(seed + 1)
+    conns = [sqlite3.connect(p, timeout=60, check_same_thread=False) for p in paths]
+    for c in conns:
+        c.execute("PRAGMA busy_timeout = 3000")
+    timers = [LockTimer(c) for c in conns]
+    with contextlib.redirect_stdout(io.StringIO()):
+        for c in conns:
+            sync_xui_sqlite.ensure_seed(c)
+    state = {}
+    lat, rows, lock = [], [], []
+    with ThreadPoolExecutor(max_workers=min(sync_xui_sqlite.PANEL_WORKERS, len(conns))) as pool:
+        for _ in range(cycles):
+            if kinds:
+                for p in paths:
+                    churn(p, rng, kinds, rate)
+            before_rows = sum(c.total_changes for c in conns)
+            before_lock = sum(t.total for t in timers)
+            out = io.StringIO()
+            t0 = time.perf_counter()
+            with contextlib.redirect_stdout(out):
+                sync_xui_sqlite.sync_panels(conns, apply=True, state=None if stateless else state, pool=pool)
+            lat.append(time.perf_counter() - t0)
+            rows.append(sum(c.total_changes for c in conns) - before_rows)
+            lock.append(sum(t.total for t in timers) - before_lock)
+            if debug:
+                print(out.getvalue(), end="")
+    for c in conns:
+        c.close()
+    return {f"panels{len(paths)}": (lat, rows, lock)}
+
+
+def db_state(path, engine):
+    """What a cycle of the engine may change ("client,tunnel": of both)"""
+    if "," in engine:
+        return {f"{e}.{k}": v for e in engine.split(",") for k, v in db_state(path, e).items()}
+    conn = sqlite3.connect(path)
+    try:
+        if engine == "tunnel":
+            return {"inbounds": conn.execute("SELECT id, up, down, total, expiry_time FROM inbounds ORDER BY id").fetchall(),
+                    "sync_meta_inbound_tunnel": conn.execute(
+                        "SELECT key, up, down, total, expiry_time, last_change FROM sync_meta_inbound_tunnel ORDER BY key").fetchall()}
+        return {"client_traffics": conn.execute("SELECT id, up, down, total, expiry_time, enable, reset FROM client_traffics ORDER BY id").fetchall(),
+                "inbounds": conn.execute("SELECT id, settings FROM inbounds ORDER BY id").fetchall(),
+                "sync_meta_client": conn.execute("SELECT key, subId, sig_hash, raw_up, raw_down FROM sync_meta_client ORDER BY key").fetchall()}
+    finally:
+        conn.close()
+
+
+def tunnel_python(conn, **kw):
+    """sync_inbound_tunnel.sync_once() through the Python planner"""
+    saved = sync_inbound_tunnel.SET_BASED
+    sync_inbound_tunnel.SET_BASED = False
+    try:
+        return sync_inbound_tunnel.sync_once(conn, **kw)
+    finally:
+        sync_inbound_tunnel.SET_BASED = saved
+
+
+def standalone(conn, apply=False, state=None):
+    """sync_once() of the client engine, then of the tunnel engine"""
+    n = sync_xui_sqlite.sync_once(conn, apply=apply, state=state.setdefault("client", {}))
+    return n + sync_inbound_tunnel.sync_once(conn, apply=apply, state=state.setdefault("tunnel", {}))
+
+
+def supervised(conn, apply=False, state=None):
+    """One cycle of conn's database through a sync_supervisor worker, run in
+    a thread that state keeps across cycles like the supervisor pins a
+    database to its worker; state["stop"] ends it"""
+    if "tasks" not in state:
+        import sync_supervisor
+        tasks, results = queue.Queue(), queue.Queue()
+        args = argparse.Namespace(engines=["client", "tunnel"], apply=apply, debug=False, backup=False,
+                                  gc_interval=0, gc_vacuum=0)
+        threading.Thread(target=sync_supervisor.worker, daemon=True,
+                         args=(0, tasks, results, args, types.SimpleNamespace(value=0.0))).start()
+        state.update(tasks=tasks, results=results, stop=lambda: tasks.put(None))
+    state["tasks"].put(("cycle", conn.execute("PRAGMA database_list").fetchone()[2]))
+    res = state["results"].get()
+    print(res["output"], end="")
+    if not res["ok"]:
+        raise sqlite3.OperationalError(res["error"])
+    return res["plans"]
+
+
+def pipelined(conn, apply=False, state=None):
+    """Two sync_pipelined() cycles of conn's database whose writer only
+    starts once the next cycle has read its snapshot, so the second
+    snapshot always overlaps the first write; then the second write is
+    waited for. The first call starts with a plain cycle for the UUID links
+    (after a link the pipelined loop plans nothing until its next cycle)."""
+    loop = state.setdefault("loop", {})
+    if "writer" not in state:
+        path = conn.execute("PRAGMA database_list").fetchone()[2]
+        pool = ThreadPoolExecutor(max_workers=1)
+        w = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        ro = sync_xui_sqlite.open_snapshot(path)
+        state.update(ro=ro, w=w, stop=lambda: (ro.close(), pool.shutdown(), w.close()))
+        sync_xui_sqlite.sync_pipelined(ro, w, pool, apply=apply, state=loop)
+        if loop.get("write"):
+            loop["write"].result()
+
+        def submit(fn, *a):
+            gate = threading.Event()
+            fut = pool.submit(lambda: gate.wait() and fn(*a))
+            return types.SimpleNamespace(done=fut.done, result=lambda: gate.set() or fut.result())
+        state["writer"] = types.SimpleNamespace(submit=submit)
+    n = 0
+    for _ in range(2):
+        n += sync_xui_sqlite.sync_pipelined(state["ro"], state["w"], state["writer"], apply=apply, state=loop)
+    if loop.get("write"):
+        loop["write"].result()
+    return n
+
+
+# check -> (engines, reference cycle, checked cycle, what matches)
+VERIFY = {"client": ("client", sync_xui_sqlite.sync_once, sync_xui_sqlite.sync_once_sql, "SQL engine matches the Python one"),
+          "tunnel": ("tunnel", tunnel_python, sync_inbound_tunnel.sync_once, "SQL engine matches the Python one"),
+          "pipeline": ("client", sync_xui_sqlite.sync_once, pipelined, "pipelined cycle overlapping its writer matches sync_once"),
+          "supervisor": ("client,tunnel", standalone, supervised, "supervised cycle matches standalone sync_once")}
+
+
+def verify_sql(path, check, cycles, kinds, rate, seed=1, debug=False):
+    """Differential check of a VERIFY cycle against its reference (an
+    engine's SQL cycle against its Python one, ...); True if both leave
+    identical databases after every cycle"""
+    engine, ref, cand, what = VERIFY[check]
+    other = path + ".sql"
+    shutil.copyfile(path, other)
+    conns = [sqlite3.connect(p, timeout=60) for p in (path, other)]
+    states = [{}, {}]
+    rngs = [random.Random(seed + 1), random.Random(seed + 1)]
+    real_time = time.time
+    clock = [real_time()]
+    time.time = lambda: clock[0]  # هر دو موتور و churn یک ساعت می‌بینن
+    mods = {"client": sync_xui_sqlite, "tunnel": sync_inbound_tunnel}
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            for c in conns:
+                for e in engine.split(","):
+                    mods[e].ensure_seed(c)
+        for cycle in range(cycles):
+            clock[0] += 30
+            out = io.StringIO()
+            for p, rng in zip((path, other), rngs):
+                if kinds:
+                    churn(p, rng, kinds, rate)
+            try:
+                with contextlib.redirect_stdout(out):
+                    ref(conns[0], apply=True, state=states[0])
+                    cand(conns[1], apply=True, state=states[1])
+            except Exception as e:
+                print(out.getvalue(), end="")
+                print(f"[VERIFY] {check} cycle {cycle}: raised {type(e).__name__}: {e}")
+                return False
+            if debug:
+                print(out.getvalue(), end="")
+            a, b = db_state(path, engine), db_state(other, engine)
+            for name in a:
+                x, y = a[name], b[name]
+                if x != y:
+                    diff = next(i for i, (u, v) in enumerate(zip(x + [None], y + [None])) if u != v)
+                    print(f"[VERIFY] {check} cycle {cycle}: {name} differs at row {diff}: {x[diff:diff + 1]} != {y[diff:diff + 1]}")
+                    return False
+        print(f"[VERIFY] {check}: {what} over {cycles} cycles")
+        return True
+    finally:
+        time.time = real_time
+        for st in states:
+            if "stop" in st:
+                st["stop"]()
+        for c in conns:
+            c.close()
+        if os.path.exists(other):
+            os.remove(other)
+
+
+def main():
+    ap = argparse.ArgumentParser(description="WinNet - Sync Benchmark")
+    ap.add_argument("--db", default="/tmp/xui_bench.db", help="Where to generate the synthetic database")
+    ap.add_argument("--inbounds", type=int, default=10, help="Number of client inbounds")
+    ap.add_argument("--clients", type=int, default=200, help="Clients per inbound (approximately)")
+    ap.add_argument("--span", type=int, default=2, help="Inbounds each subscription spans")
+    ap.add_argument("--tunnels", type=int, default=4, help="Tunnel groups (two inbounds each)")
+    ap.add_argument("--mult-ratio", type=float, default=0.25, help="Share of inbounds with an [xN] remark multiplier")
+    ap.add_argument("--shared-uuid", type=float, default=0.05, help="Share of client copies without subId (UUID-linked)")
+    ap.add_argument("--cycles", type=int, default=30, help="Sync cycles to run")
+    ap.add_argument("--churn", default="growth,reset,expiry", help=f"Comma separated subset of {','.join(CHURN_KINDS)} (empty = idle)")
+    ap.add_argument("--churn-rate", type=float, default=0.05, help="Share of client rows touched per cycle")
+    ap.add_argument("--engines", default="client,tunnel", help="Comma separated: client,tunnel")
+    ap.add_argument("--unified", action="store_true", help="Run the engines together via run_engines()")
+    ap.add_argument("--panels", type=int, default=1, help="Generate this many panel DBs with the same subIds (client engine)")
+    ap.add_argument("--stateless", action="store_true", help="Do not keep loop state between cycles")
+    ap.add_argument("--sql", action="store_true", help="Run the client engine through sync_once_sql()")
+    ap.add_argument("--plan-workers", type=int, default=0, help="Plan the client engine on this many processes (plan_sharded)")
+    ap.add_argument("--verify-sql", action="store_true",
+                    help="Check the SQL engines against the Python ones (and the pipelined / supervised cycles) instead of benchmarking")
+    ap.add_argument("--trace-mem", action="store_true", help="Report the peak Python heap of the sync cycles (slower)")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--seeds", type=int, default=1, help="With --verify-sql: check this many databases, seeds --seed and up")
+    ap.add_argument("--keep", action="store_true", help="Keep the generated database")
+    ap.add_argument("--debug", action="store_true", help="Show the sync output of every cycle")
+    args = ap.parse_args()
+
+    kinds = [k for k in args.churn.split(",") if k]
+    bad = [k for k in kinds if k not in CHURN_KINDS]
+    engines = [e for e in args.engines.split(",") if e]
+    if bad or not engines or any(e not in sync_xui_sqlite.ENGINES for e in engines):
+        print("[ERROR] Bad --churn or --engines value")
+        return
+
+    paths = [args.db] + [f"{args.db}.panel{i}" for i in range(1, args.panels)]
+    t0 = time.perf_counter()
+    for i, path in enumerate(paths):
+        n_subs = generate_db(path, args.inbounds, args.clients, args.span, args.tunnels,
+                             args.mult_ratio, args.shared_uuid, args.seed + i)
+    print(f"[INFO] Generated {len(paths)} x {args.db}: inbounds={args.inbounds} subscriptions={n_subs} "
+          f"tunnel_groups={args.tunnels} size={os.path.getsize(args.db) >> 10}KiB "
+          f"in {time.perf_counter() - t0:.1f}s")
+    try:
+        if args.verify_sql:
+            ok = True
+            for seed in range(args.seed, args.seed + max(1, args.seeds)):
+                if seed != args.seed:
+                    generate_db(args.db, args.inbounds, args.clients, args.span, args.tunnels,
+                                args.mult_ratio, args.shared_uuid, seed)
+                ok = all([verify_sql(args.db, check, args.cycles, kinds, args.churn_rate, seed=seed, debug=args.debug)
+                          for check, v in VERIFY.items() if set(v[0].split(",")) <= set(engines)]) and ok
+            if not ok:
+                print("[VERIFY] FAILED: a checked cycle does not match its reference")
+                raise SystemExit(1)
+            print("[VERIFY] OK")
+            return
+        if args.panels > 1:
+            stats = run_panels_bench(paths, args.cycles, kinds, args.churn_rate,
+                                     stateless=args.stateless, seed=args.seed, debug=args.debug)
+        else:
+            stats = run_bench(args.db, engines, args.cycles, kinds, args.churn_rate,
+                              unified=args.unified, stateless=args.stateless, seed=args.seed, debug=args.debug,
+                              trace_mem=args.trace_mem, sql=args.sql, plan_workers=args.plan_workers)
+        for name, (lat, rows, lock) in stats.items():
+            report(name, lat, rows, lock)
+        print(f"[BENCH] peak_rss={resource.getrusage(resource.RUSAGE_SELF).ru_maxrss >> 10}MiB")
+    finally:
+        for path in paths:
+            if not args.keep and os.path.exists(path):
+                os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
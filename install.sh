@@ -198,6 +198,16 @@ update_client_sync() {
 
 enable_tunnel_sync() {
     echo ""
+    # Tunnel sync imports its shared helpers from sync_xui_sqlite.py
+    if [ ! -f "$SCRIPT_PATH" ]; then
+        if curl -fsSL "$GITHUB_RAW/sync_xui_sqlite.py" -o "$SCRIPT_PATH"; then
+            chmod 755 "$SCRIPT_PATH"
+        else
+            echo -e "${RED}[ERROR]${NC} Failed to download sync_xui_sqlite.py (needed by tunnel sync)."
+            read -p "Press Enter to continue..." _
+            return
+        fi
+    fi
     if [ ! -f "$TUNNEL_SCRIPT_PATH" ]; then
         echo -e "${BLUE}[i]${NC} Tunnel sync not installed. Downloading..."
         if curl -fsSL "$GITHUB_RAW/sync_inbound_tunnel.py" -o "$TUNNEL_SCRIPT_PATH"; then
@@ -259,6 +269,13 @@ update_tunnel_sync() {
         read -p "Press Enter to continue..." _
         return
     fi
+    # Shared helpers live in sync_xui_sqlite.py: keep both scripts on the same version
+    if curl -fsSL "$GITHUB_RAW/sync_xui_sqlite.py" -o "$SCRIPT_PATH"; then
+        chmod 755 "$SCRIPT_PATH"
+        systemctl try-restart sync_xui.service > /dev/null 2>&1
+    else
+        echo -e "${YELLOW}[!]${NC} Failed to download sync_xui_sqlite.py (shared helpers of tunnel sync)."
+    fi
     if curl -fsSL "$GITHUB_RAW/sync_inbound_tunnel.service" -o "$TUNNEL_SERVICE_PATH"; then
         echo -e "${GREEN}[OK]${NC} Tunnel sync service file updated."
     else
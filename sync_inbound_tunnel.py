@@ -6,11 +6,19 @@ Syncs traffic (up/down/total) and expiry_time across inbounds
 that share the same remark and have protocol 'tunnel' or 'tun'.
 """
 from __future__ import annotations
-import sqlite3, json, argparse, os, time, shutil
-from datetime import datetime
+import sqlite3, json, argparse, os, time
+# loop, watch, metrics, backup, schema and GC helpers are shared with the client daemon
+from sync_xui_sqlite import (
+    db_changed, new_metrics, lap, migrate, delete_stale, GC_INTERVAL, GC_BATCH,
+    db_watch_names, inotify_open, wait_for_change, new_loop_metrics, render_metrics,
+    write_textfile, start_metrics_server, maybe_backup,
+)
 
 DB_DEFAULT = "/etc/x-ui/x-ui.db"
 TUNNEL_PROTOCOLS = ("tunnel", "tun")
+# window functions (3.25) + UPDATE ... FROM (3.33); older SQLite uses the Python planner
+SET_BASED = sqlite3.sqlite_version_info >= (3, 33, 0)
+WS = "' ' || char(9, 10, 11, 12, 13)"  # like str.strip() for ASCII whitespace
 
 def jload(s):
     if isinstance(s, dict): return s
@@ -20,8 +28,7 @@ def jload(s):
 def jdump(o):
     return json.dumps(o, ensure_ascii=False, separators=(",", ":"))
 
-def ensure_meta(conn):
-    c = conn.cursor()
+def _meta_v1(c):
     c.execute("""
     CREATE TABLE IF NOT EXISTS sync_meta_inbound_tunnel(
       key TEXT PRIMARY KEY,
@@ -34,21 +41,43 @@ def ensure_meta(conn):
       expiry_time INTEGER DEFAULT 0,
       last_change INTEGER DEFAULT 0
     )""")
-    conn.commit()
+
+def _meta_v2(c):
+    # inbounds belongs to x-ui: an index of ours there would add to its write
+    # cost and change its scan order, so the protocol index goes if it exists
+    c.execute("DROP INDEX IF EXISTS idx_sync_inbounds_protocol")
+
+# Version n = the first n steps; only ever append. Steps must also work on a
+# database from before versioning, where their objects may already exist.
+MIGRATIONS = (_meta_v1, _meta_v2)
+
+def ensure_meta(conn):
+    """Migrate the meta table to the current schema (once at startup, never per cycle)"""
+    migrate(conn, "tunnel", MIGRATIONS)
 
 def meta_key(remark, protocol, iid):
     return f"{remark}|{protocol}|{iid}"
 
-def load_tunnel_inbounds(conn):
-    """Load all inbounds with tunnel/tun protocol"""
-    cur = conn.cursor()
-    placeholders = ",".join("?" for _ in TUNNEL_PROTOCOLS)
-    cur.execute(f"""
-        SELECT id, remark, protocol, up, down, total, expiry_time
-        FROM inbounds
-        WHERE LOWER(protocol) IN ({placeholders})
-    """, [p.lower() for p in TUNNEL_PROTOCOLS])
-    rows = cur.fetchall()
+def load_tunnel_inbounds(conn, rows=None):
+    """Load all inbounds with tunnel/tun protocol
+
+    rows: an already fetched (id, settings, remark, protocol, up, down, total,
+    expiry_time) snapshot of inbounds to filter instead of querying.
+    """
+    if rows is not None:
+        protos = {p.lower() for p in TUNNEL_PROTOCOLS}
+        rows = [(r[0], r[2], r[3], r[4], r[5], r[6], r[7]) for r in rows
+                if (r[3] or "").lower() in protos]
+    else:
+        cur = conn.cursor()
+        placeholders = ",".join("?" for _ in TUNNEL_PROTOCOLS)
+        cur.execute(f"""
+            SELECT id, remark, protocol, up, down, total, expiry_time
+            FROM inbounds
+            WHERE LOWER(protocol) IN ({placeholders})
+            ORDER BY id
+        """, TUNNEL_PROTOCOLS)
+        rows = cur.fetchall()
     out = []
     for iid, remark, protocol, up, down, total, expiry_time in rows:
         out.append({
@@ -103,16 +132,38 @@ def ensure_seed(conn, debug=False):
     if debug:
         print(f"[INFO] Seeded {n} tunnel inbound entries")
 
-def sync_once(conn, apply=False, debug=False):
-    """Run one sync cycle"""
-    ensure_meta(conn)
-    cur = conn.cursor()
+def sync_once(conn, apply=False, debug=False, state=None, snapshot=None):
+    """Run one sync cycle (skipped when state says nothing changed)
+
+    snapshot is set when running under the client daemon's run_engines():
+    the change check and the inbounds read are done by the caller, and the
+    writes are appended to snapshot["writes"] (functions of the connection)
+    for run_engines() to do with the other engines' writes. The schema is
+    migrated once at startup (ensure_meta).
+    """
+    m = new_metrics(state)
+    commit = snapshot is None
+    if commit:
+        if not db_changed(conn, state):
+            if debug:
+                print("[IDLE] Database unchanged, cycle skipped")
+            m["skipped"] = 1
+            return 0
+        if state is not None:
+            state["dirty"] = True
+    if SET_BASED:
+        return sync_set_based(conn, m, apply=apply, debug=debug, state=state, commit=commit, snapshot=snapshot)
     now = int(time.time())
 
-    inbounds = load_tunnel_inbounds(conn)
+    t = time.perf_counter()
+    inbounds = load_tunnel_inbounds(conn, rows=snapshot["inbounds"] if snapshot else None)
+    t = lap(m, "load", t)
     meta_map = load_meta_map(conn)
+    m["rows_read"] += len(inbounds) + len(meta_map)
 
     if not inbounds:
+        if state is not None:
+            state["dirty"] = False
         if debug:
             print("[INFO] No tunnel/tun inbounds found")
         return 0
@@ -140,16 +191,24 @@ def sync_once(conn, apply=False, debug=False):
                 print(f"[META] change id={inb['id']} remark={inb['remark']} "
                       f"up={inb['up']} down={inb['down']} total={inb['total']} expiry={inb['expiry_time']}")
 
-    if meta_updates:
+    def write_meta(c):
         for row in meta_updates:
-            cur.execute("""
+            c.execute("""
                 INSERT OR REPLACE INTO sync_meta_inbound_tunnel
                 (key, remark, protocol, inbound_id, up, down, total, expiry_time, last_change)
                 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
             """, row)
-        conn.commit()
+
+    if meta_updates:
+        if commit:
+            write_meta(conn)
+            conn.commit()
+        else:
+            snapshot["writes"].append(write_meta)
+            snapshot.setdefault("m", m)
         if debug:
             print(f"[INFO] Meta updated: {len(meta_updates)} entries")
+    t = lap(m, "meta", t)
 
     # Group by (remark, protocol) - only groups with 2+ inbounds need sync
     groups = {}
@@ -219,7 +278,13 @@ def sync_once(conn, apply=False, debug=False):
                     "target_expiry": ref_expiry,
                 })
 
+    m["groups_planned"] = sum(1 for items in groups.values() if len(items) >= 2)
+    m["plans"] = len(plans)
+    t = lap(m, "plan", t)
+
     if not plans:
+        if state is not None:
+            state["dirty"] = bool(meta_updates)
         print("[INFO] No changes required (all tunnel inbounds already in sync)")
         return 0
 
@@ -228,75 +293,341 @@ def sync_once(conn, apply=False, debug=False):
             print(f"[PLAN] id={p['id']} remark={p['remark']} changes={p['changes']}")
 
     if not apply:
+        if state is not None:
+            state["dirty"] = bool(meta_updates)
         print(f"[DRY-RUN] {len(plans)} changes planned (use --apply to execute)")
         return len(plans)
 
     # Apply changes
-    conn.execute("BEGIN")
-    writes = 0
-    for p in plans:
-        cur.execute("""
-            UPDATE inbounds
-            SET up = ?, down = ?, total = ?, expiry_time = ?
-            WHERE id = ?
-        """, (p["target_up"], p["target_down"], p["target_total"], p["target_expiry"], p["id"]))
-        writes += 1
+    def write_plans(c):
+        t = time.perf_counter()
+        writes = 0
+        for p in plans:
+            c.execute("""
+                UPDATE inbounds
+                SET up = ?, down = ?, total = ?, expiry_time = ?
+                WHERE id = ?
+            """, (p["target_up"], p["target_down"], p["target_total"], p["target_expiry"], p["id"]))
+            writes += 1
 
-        if debug:
-            print(f"[APPLY] id={p['id']} remark={p['remark']} "
-                  f"up={p['target_up']} down={p['target_down']} "
-                  f"total={p['target_total']} expiry={p['target_expiry']}")
+            if debug:
+                print(f"[APPLY] id={p['id']} remark={p['remark']} "
+                      f"up={p['target_up']} down={p['target_down']} "
+                      f"total={p['target_total']} expiry={p['target_expiry']}")
 
-    # Update meta after apply
-    for p in plans:
-        key = meta_key(p["remark"], p["protocol"], p["id"])
-        cur.execute("""
+        # Update meta after apply
+        for p in plans:
+            key = meta_key(p["remark"], p["protocol"], p["id"])
+            c.execute("""
+                INSERT OR REPLACE INTO sync_meta_inbound_tunnel
+                (key, remark, protocol, inbound_id, up, down, total, expiry_time, last_change)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (key, p["remark"], p["protocol"], p["id"],
+                  p["target_up"], p["target_down"], p["target_total"], p["target_expiry"], now))
+        lap(m, "apply", t)
+        print(f"[APPLIED] {writes} inbound(s) updated")
+
+    if not commit:
+        snapshot["writes"].append(write_plans)
+        snapshot.setdefault("m", m)
+        return len(plans)
+    tl = time.perf_counter()
+    conn.execute("BEGIN IMMEDIATE")
+    m["lock_wait"] += time.perf_counter() - tl
+    try:
+        write_plans(conn)
+        t = time.perf_counter()
+        conn.commit()
+        lap(m, "commit", t)
+    except Exception:
+        conn.rollback()
+        raise
+    return len(plans)
+
+# --- set-based engine: a cycle as a few statements over temp tables ---
+# {src}: inbounds, or temp.sync_tunnel_rows holding the caller's snapshot
+SQL_TUNNELS = f"""
+SELECT id, trim(COALESCE(remark, ''), {WS}) AS remark, trim(lower(COALESCE(protocol, '')), {WS}) AS protocol,
+       CAST(COALESCE(up, 0) AS INTEGER) AS up, CAST(COALESCE(down, 0) AS INTEGER) AS down,
+       CAST(COALESCE(total, 0) AS INTEGER) AS total, CAST(COALESCE(expiry_time, 0) AS INTEGER) AS expiry_time
+FROM {{src}}
+WHERE lower(protocol) IN ({",".join("?" for _ in TUNNEL_PROTOCOLS)})
+"""
+
+# every tunnel inbound with its meta state as of after this cycle's upserts:
+# changed = new or different from its meta row, last_change = now if changed
+SQL_TUNNEL_ROWS = """
+INSERT INTO temp.sync_tunnels
+SELECT key, id, remark, protocol, up, down, total, expiry_time, CASE WHEN changed THEN ? ELSE lc END, changed
+FROM (
+  SELECT t.*, m.last_change AS lc, m.key IS NULL OR m.up IS NOT t.up OR m.down IS NOT t.down
+         OR m.total IS NOT t.total OR m.expiry_time IS NOT t.expiry_time AS changed
+  FROM (SELECT remark || '|' || protocol || '|' || id AS key, * FROM ({tunnels})) t
+  LEFT JOIN sync_meta_inbound_tunnel m ON m.key = t.key
+)
+"""
+
+# per (remark, protocol) group of 2+: max up/down, and the reference (latest
+# last_change, lowest id on ties) for total/expiry_time and reset detection
+SQL_TUNNEL_PLAN = """
+WITH w AS (
+  SELECT t.*, count(*) OVER g AS n, max(t.up) OVER g AS max_up, max(t.down) OVER g AS max_down,
+         first_value(t.id) OVER r AS ref_id, first_value(t.up) OVER r AS ref_up, first_value(t.down) OVER r AS ref_down,
+         first_value(t.total) OVER r AS ref_total, first_value(t.expiry_time) OVER r AS ref_expiry
+  FROM temp.sync_tunnels t
+  WINDOW g AS (PARTITION BY t.remark, t.protocol),
+         r AS (PARTITION BY t.remark, t.protocol ORDER BY t.last_change DESC, t.id
+               ROWS BETWEEN UNBOUNDED PRECEDING AND UNBOUNDED FOLLOWING)
+), p AS (
+  SELECT *, ref_up + ref_down < max_up + max_down AS is_reset,
+         CASE WHEN ref_up + ref_down < max_up + max_down THEN ref_up ELSE max_up END AS target_up,
+         CASE WHEN ref_up + ref_down < max_up + max_down THEN ref_down ELSE max_down END AS target_down
+  FROM w WHERE n >= 2
+)
+INSERT INTO temp.sync_tunnel_plan
+SELECT id, key, remark, protocol, up, down, total, expiry_time, target_up, target_down, ref_total, ref_expiry,
+       is_reset, ref_id
+FROM p
+WHERE up <> target_up OR down <> target_down OR total <> ref_total OR expiry_time <> ref_expiry
+"""
+
+# groups with a member that x-ui changed or deleted since the plan was read
+SQL_TUNNEL_MOVED = """
+DELETE FROM temp.sync_tunnel_plan WHERE remark || '|' || protocol IN (
+  SELECT t.remark || '|' || t.protocol
+  FROM temp.sync_tunnels t LEFT JOIN inbounds i ON i.id = t.id
+  WHERE i.id IS NULL OR CAST(COALESCE(i.up, 0) AS INTEGER) <> t.up OR CAST(COALESCE(i.down, 0) AS INTEGER) <> t.down
+     OR CAST(COALESCE(i.total, 0) AS INTEGER) <> t.total OR CAST(COALESCE(i.expiry_time, 0) AS INTEGER) <> t.expiry_time
+)
+"""
+
+def create_temp_tables(conn):
+    """The engine's temp tables, once per connection; cycles only DELETE"""
+    conn.execute("""CREATE TEMP TABLE IF NOT EXISTS sync_tunnel_rows(
+        id, settings, remark, protocol, up, down, total, expiry_time)""")
+    conn.execute("""CREATE TEMP TABLE IF NOT EXISTS sync_tunnels(
+        key, id, remark, protocol, up, down, total, expiry_time, last_change, changed)""")
+    conn.execute("""CREATE TEMP TABLE IF NOT EXISTS sync_tunnel_plan(
+        id, key, remark, protocol, up, down, total, expiry_time, target_up, target_down, ref_total, ref_expiry,
+        is_reset, ref_id)""")
+    for table in ("sync_tunnel_rows", "sync_tunnels", "sync_tunnel_plan"):
+        conn.execute(f"DELETE FROM temp.{table}")
+
+def sync_set_based(conn, m, apply=False, debug=False, state=None, commit=True, snapshot=None):
+    """sync_once() body for SQLite >= 3.33: meta changes, grouping, the
+    max/reset/reference selection and the writes are a handful of
+    statements, whatever the number of tunnel groups.
+
+    The plan is built under a deferred read (temp tables only), and the
+    write lock is taken only when there are meta rows or plans to write.
+    A group with a member that x-ui changed in between is left for the next
+    cycle. With commit=False snapshot holds the caller's inbounds rows and
+    the write is appended to snapshot["writes"] (see sync_once). `bench_sync.py
+    --verify-sql` checks it against the Python planner.
+    """
+    now = int(time.time())
+    t = time.perf_counter()
+    conn.execute("BEGIN")
+    try:
+        create_temp_tables(conn)
+        src = "inbounds"
+        if snapshot is not None:
+            conn.executemany("INSERT INTO temp.sync_tunnel_rows VALUES (?, NULL, ?, ?, ?, ?, ?, ?)",
+                             [(r[0],) + tuple(r[2:8]) for r in snapshot["inbounds"]])
+            src = "temp.sync_tunnel_rows"
+        conn.execute(SQL_TUNNEL_ROWS.format(tunnels=SQL_TUNNELS.format(src=src)), (now, *TUNNEL_PROTOCOLS))
+        n, meta_updates = conn.execute("SELECT count(*), COALESCE(sum(changed), 0) FROM temp.sync_tunnels").fetchone()
+        m["rows_read"] += n
+        t = lap(m, "load", t)
+        if not n:
+            conn.commit()
+            if state is not None:
+                state["dirty"] = False
+            if debug:
+                print("[INFO] No tunnel/tun inbounds found")
+            return 0
+        if debug:
+            for iid, remark, up, down, total, expiry in conn.execute(
+                    "SELECT id, remark, up, down, total, expiry_time FROM temp.sync_tunnels WHERE changed"):
+                print(f"[META] change id={iid} remark={remark} up={up} down={down} total={total} expiry={expiry}")
+        t = lap(m, "meta", t)
+
+        conn.execute(SQL_TUNNEL_PLAN)
+        plans = conn.execute("SELECT * FROM temp.sync_tunnel_plan ORDER BY id").fetchall()
+        m["groups_planned"] = conn.execute(
+            "SELECT count(*) FROM (SELECT 1 FROM temp.sync_tunnels GROUP BY remark, protocol HAVING count(*) >= 2)").fetchone()[0]
+        m["plans"] = len(plans)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    t = lap(m, "plan", t)
+    if debug:
+        for p in sorted({(p[2], p[3], p[13], p[8], p[9]) for p in plans if p[12]}):
+            print(f"[RESET] remark={p[0]} proto={p[1]} ref_id={p[2]} ref_up={p[3]} ref_down={p[4]}")
+        for iid, _key, remark, _proto, up, down, total, expiry, tu, td, tt, te, _r, _ref in plans:
+            changes = {k: v for k, v in (("up", (up, tu)), ("down", (down, td)), ("total", (total, tt)),
+                                         ("expiry_time", (expiry, te))) if v[0] != v[1]}
+            print(f"[PLAN] id={iid} remark={remark} changes={changes}")
+
+    def write(c):
+        t = time.perf_counter()
+        c.execute("""
             INSERT OR REPLACE INTO sync_meta_inbound_tunnel
             (key, remark, protocol, inbound_id, up, down, total, expiry_time, last_change)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (key, p["remark"], p["protocol"], p["id"],
-              p["target_up"], p["target_down"], p["target_total"], p["target_expiry"], now))
+            SELECT key, remark, protocol, id, up, down, total, expiry_time, last_change
+            FROM temp.sync_tunnels WHERE changed
+        """)
+        if plans and apply:
+            skipped = c.execute(SQL_TUNNEL_MOVED).rowcount
+            c.execute("""
+                UPDATE inbounds
+                SET up = p.target_up, down = p.target_down, total = p.ref_total, expiry_time = p.ref_expiry
+                FROM temp.sync_tunnel_plan p
+                WHERE inbounds.id = p.id
+            """)
+            c.execute("""
+                INSERT OR REPLACE INTO sync_meta_inbound_tunnel
+                (key, remark, protocol, inbound_id, up, down, total, expiry_time, last_change)
+                SELECT key, remark, protocol, id, target_up, target_down, ref_total, ref_expiry, ?
+                FROM temp.sync_tunnel_plan
+            """, (now,))
+            if skipped and state is not None:
+                state["dirty"] = True
+            print(f"[APPLIED] {len(plans) - skipped} inbound(s) updated"
+                  + (f", skipped {skipped} changed since the read" if skipped else ""))
+        lap(m, "apply", t)
+
+    if meta_updates or (plans and apply):
+        if not commit:
+            snapshot["writes"].append(write)
+            snapshot.setdefault("m", m)
+        else:
+            tl = time.perf_counter()
+            conn.execute("BEGIN IMMEDIATE")
+            m["lock_wait"] += time.perf_counter() - tl
+            try:
+                write(conn)
+                t = time.perf_counter()
+                conn.commit()
+                lap(m, "commit", t)
+            except Exception:
+                conn.rollback()
+                raise
 
-    conn.commit()
-    print(f"[APPLIED] {writes} inbound(s) updated")
+    if not plans:
+        if state is not None:
+            state["dirty"] = bool(meta_updates)
+        print("[INFO] No changes required (all tunnel inbounds already in sync)")
+        return 0
+    if not apply:
+        if state is not None:
+            state["dirty"] = bool(meta_updates)
+        print(f"[DRY-RUN] {len(plans)} changes planned (use --apply to execute)")
     return len(plans)
 
+# --- GC: meta rows of inbounds that no longer exist ---
+def gc_meta(conn, batch=GC_BATCH, vacuum=0, debug=False):
+    """Delete sync_meta_inbound_tunnel rows whose key no live tunnel inbound
+    has any more (deleted inbounds, renamed remarks, changed protocols),
+    through delete_stale(). Returns the rows deleted.
+    """
+    before = int(time.time())
+    # Meta first, then inbounds: an inbound added in between is never stale
+    keys = [k for (k,) in conn.execute("SELECT key FROM sync_meta_inbound_tunnel")]
+    live = {meta_key(inb["remark"], inb["protocol"], inb["id"]) for inb in load_tunnel_inbounds(conn)}
+    return delete_stale(conn, "sync_meta_inbound_tunnel", [k for k in keys if k not in live],
+                        before, batch, vacuum, debug)
+
 def main():
     ap = argparse.ArgumentParser(description="WinNet - Inbound Tunnel Sync")
     ap.add_argument("--db", default=DB_DEFAULT, help="Path to x-ui database")
-    ap.add_argument("--interval", type=int, default=30, help="Sync interval in seconds (0 = run once)")
+    ap.add_argument("--interval", type=int, default=30, help="Sync interval in seconds (0 = run once); max latency with --watch")
+    ap.add_argument("--watch", action="store_true", help="Run a cycle when x-ui.db / -wal / -journal change (inotify)")
+    ap.add_argument("--debounce", type=float, default=0.5, help="With --watch: seconds of quiet after the last change")
     ap.add_argument("--apply", action="store_true", help="Apply changes (otherwise dry-run)")
-    ap.add_argument("--backup", action="store_true", help="Create backup before changes")
+    ap.add_argument("--backup", action="store_true", help="Create an online backup before applying changes")
+    ap.add_argument("--backup-interval", type=int, default=86400, help="Seconds between backups (also across restarts)")
+    ap.add_argument("--backup-keep", type=int, default=5, help="Backups to keep, 0 = all")
+    ap.add_argument("--backup-compress", action="store_true", help="Gzip backups")
     ap.add_argument("--init", action="store_true", help="Initialize meta table")
     ap.add_argument("--debug", action="store_true", help="Enable debug output")
+    ap.add_argument("--metrics-file", help="Write Prometheus metrics here after every cycle (textfile collector)")
+    ap.add_argument("--metrics-port", type=int, help="Serve Prometheus metrics on 127.0.0.1:PORT/metrics")
+    ap.add_argument("--gc-interval", type=int, default=GC_INTERVAL,
+                    help="Seconds between deletions of meta rows of inbounds that no longer exist (0 = off)")
+    ap.add_argument("--gc-vacuum", type=int, default=0, metavar="PAGES",
+                    help="After GC, PRAGMA incremental_vacuum up to this many pages (needs auto_vacuum=INCREMENTAL)")
+    ap.add_argument("--python", action="store_true", help="Plan in Python instead of the set-based SQL engine")
     args = ap.parse_args()
+    global SET_BASED
+    SET_BASED = SET_BASED and not args.python
 
     if not os.path.exists(args.db):
         print("[ERROR] Database not found:", args.db)
         return
 
-    if args.apply and args.backup:
-        ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-        bak = f"{args.db}.tunnel_bak_{ts}"
-        shutil.copy2(args.db, bak)
-        print(f"[INFO] Backup: {bak}")
-
     conn = sqlite3.connect(args.db, timeout=60, check_same_thread=False)
     conn.execute("PRAGMA busy_timeout = 3000")
     try:
+        if not args.init:
+            maybe_backup(conn, args, ".tunnel_bak_")
         if args.init:
             ensure_seed(conn, debug=args.debug)
             return
+        ensure_meta(conn)
         if args.interval <= 0:
             sync_once(conn, apply=args.apply, debug=args.debug)
         else:
-            print(f"[INFO] Loop interval={args.interval}s apply={args.apply}")
+            print(f"[INFO] Loop interval={args.interval}s apply={args.apply} watch={args.watch}")
+            state = {}
+            fd = inotify_open(args.db) if args.watch else None
+            if args.watch and fd is None:
+                print("[WARN] inotify unavailable, falling back to interval polling")
+            names = db_watch_names(args.db)
+            loop = new_loop_metrics(["tunnel"])
+            holder = {}
+            if args.metrics_port:
+                start_metrics_server(args.metrics_port, holder)
+            next_gc = 0.0
             while True:
+                maybe_backup(conn, args, ".tunnel_bak_")
+                t0 = time.perf_counter()
+                tc = conn.total_changes
                 try:
-                    sync_once(conn, apply=args.apply, debug=args.debug)
+                    sync_once(conn, apply=args.apply, debug=args.debug, state=state)
                 except Exception as e:
+                    loop["errors"] += 1
                     print(f"[ERROR] iteration: {e}")
-                time.sleep(args.interval)
+                dt = time.perf_counter() - t0
+                m = state.get("metrics")
+                loop["cycles"] += 1
+                loop["cycle_seconds"] = dt
+                loop["overrun_seconds"] = max(0.0, dt - args.interval)
+                loop["rows_written"] = conn.total_changes - tc
+                loop["last_cycle"] = time.time()
+                if m and m["skipped"]:
+                    loop["skipped"] += 1
+                if args.debug and m:
+                    phases = " ".join(f"{ph}={v * 1000:.1f}ms" for ph, v in m["phases"].items())
+                    print(f"[TIMING] cycle={dt * 1000:.1f}ms rows_written={loop['rows_written']} {phases}")
+                if args.gc_interval > 0 and time.monotonic() >= next_gc:
+                    next_gc = time.monotonic() + args.gc_interval
+                    try:
+                        loop["gc_deleted"] += gc_meta(conn, vacuum=args.gc_vacuum, debug=args.debug)
+                    except Exception as e:
+                        print(f"[ERROR] gc: {e}")
+                if args.metrics_file or args.metrics_port:
+                    holder["text"] = render_metrics({"tunnel": m}, loop)
+                    if args.metrics_file:
+                        try:
+                            write_textfile(args.metrics_file, holder["text"])
+                        except OSError as e:
+                            print(f"[ERROR] metrics file: {e}")
+                if fd is not None:
+                    wait_for_change(fd, names, args.interval, args.debounce)
+                else:
+                    time.sleep(args.interval)
     finally:
         conn.close()
 
@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+WinNet - Sync Supervisor
+Runs the client and tunnel sync cycles of many x-ui instances (one x-ui.db
+each) from a bounded pool of worker processes, instead of one pair of
+sync_xui_sqlite.py / sync_inbound_tunnel.py services per instance.
+
+Every database is pinned to one worker, which keeps its connection and loop
+state (caches, change detection) across cycles. The supervisor schedules each
+database on its own clock, backs off databases whose cycles fail, restarts
+dead workers and reports per-database status in one place.
+
+    python3 sync_supervisor.py --discover '/etc/x-ui*/x-ui.db' --workers 4 --apply
+"""
+from __future__ import annotations
+import sqlite3, argparse, contextlib, glob, heapq, io, json, multiprocessing as mp, os, queue, time
+
+import sync_xui_sqlite
+
+MAX_BACKOFF = 600  # seconds between retries of a database whose cycles keep failing
+CYCLE_TIMEOUT = 600  # seconds one cycle may run before its worker counts as hung
+
+
+def open_db(path, engines):
+    """Connection for one instance, with the meta tables of its engines in place"""
+    conn = sqlite3.connect(path, timeout=60)
+    conn.execute("PRAGMA busy_timeout = 3000")
+    if "client" in engines:
+        sync_xui_sqlite.ensure_meta(conn)
+    if "tunnel" in engines:
+        import sync_inbound_tunnel
+        sync_inbound_tunnel.ensure_meta(conn)
+    return conn
+
+
+def worker(wid, tasks, results, args, beat):
+    """Worker process: runs cycles for the databases the supervisor sends it.
+
+    Tasks are ("cycle", path) or ("drop", path); None stops the worker. One
+    result dict is put on `results` per cycle, failures included. beat (a
+    shared double) holds the time.time() the current task started, 0 while
+    idle, for the supervisor's watchdog.
+    """
+    dbs = {}  # path -> (conn, states)
+    gc_next = {}  # path -> monotonic time of the next meta GC
+    while True:
+        beat.value = 0.0
+        msg = tasks.get()
+        if msg is None:
+            break
+        beat.value = time.time()
+        kind, path = msg
+        if kind == "drop":
+            gc_next.pop(path, None)
+            ent = dbs.pop(path, None)
+            if ent:
+                ent[0].close()
+            continue
+        out = io.StringIO()
+        res = {"worker": wid, "db": path, "ok": True, "error": "", "plans": 0, "rows_written": 0, "skipped": False,
+               "gc_deleted": 0}
+        t0 = time.perf_counter()
+        try:
+            with contextlib.redirect_stdout(out):
+                ent = dbs.get(path)
+                if ent is None:
+                    ent = dbs[path] = (open_db(path, args.engines), {})
+                conn, states = ent
+                sync_xui_sqlite.maybe_backup(conn, args, ".bak_", path)
+                tc = conn.total_changes
+                res["plans"] = sync_xui_sqlite.run_engines(conn, args.engines, apply=args.apply,
+                                                          debug=args.debug, states=states)
+                res["rows_written"] = conn.total_changes - tc
+                res["skipped"] = all(states.get(e, {}).get("metrics", {}).get("skipped") for e in args.engines)
+                if args.gc_interval > 0 and time.monotonic() >= gc_next.get(path, 0.0):
+                    gc_next[path] = time.monotonic() + args.gc_interval
+                    res["gc_deleted"] = gc_db(conn, args)
+        except Exception as e:
+            res["ok"] = False
+            res["error"] = str(e)
+            # اتصال رو دور بریز، چرخه بعد از نو باز میشه
+            ent = dbs.pop(path, None)
+            if ent:
+                with contextlib.suppress(Exception):
+                    ent[0].close()
+        res["seconds"] = time.perf_counter() - t0
+        res["output"] = out.getvalue()
+        results.put(res)
+    for conn, _ in dbs.values():
+        conn.close()
+
+
+def gc_db(conn, args):
+    """Delete the stale meta rows of the selected engines; returns the rows deleted"""
+    n = 0
+    if "client" in args.engines:
+        n += sync_xui_sqlite.gc_meta(conn, vacuum=args.gc_vacuum, debug=args.debug)
+    if "tunnel" in args.engines:
+        import sync_inbound_tunnel
+        n += sync_inbound_tunnel.gc_meta(conn, vacuum=args.gc_vacuum, debug=args.debug)
+    return n
+
+
+def discover(args):
+    """--db paths plus whatever the --discover globs match right now"""
+    paths = list(args.db)
+    for pattern in args.discover:
+        paths.extend(sorted(glob.glob(pattern)))
+    out = []
+    for p in map(os.path.abspath, paths):
+        if p not in out and os.path.isfile(p):
+            out.append(p)
+    return out
+
+
+def new_status(path, wid):
+    return {"db": path, "worker": wid, "ok": None, "error": "", "cycles": 0, "errors": 0, "skipped": 0,
+            "failures": 0, "cycle_seconds": 0.0, "plans": 0, "rows_written": 0, "last_cycle": 0.0, "gc_deleted": 0}
+
+
+def render_status(status, workers):
+    """Prometheus text exposition of the per-database status"""
+    out = []
+
+    def family(name, typ, doc, key, fmt="{}"):
+        out.append(f"# HELP winnet_supervisor_{name} {doc}")
+        out.append(f"# TYPE winnet_supervisor_{name} {typ}")
+        for s in status.values():
+            out.append(f'winnet_supervisor_{name}{{db="{sync_xui_sqlite.prom_label(s["db"])}"}} {fmt.format(key(s))}')
+
+    family("up", "gauge", "1 if the last cycle of the database succeeded", lambda s: int(bool(s["ok"])))
+    family("cycle_seconds", "gauge", "Wall time of the last cycle", lambda s: s["cycle_seconds"], "{:.6f}")
+    family("plans", "gauge", "Planned changes in the last cycle", lambda s: s["plans"])
+    family("rows_written", "gauge", "Rows written in the last cycle", lambda s: s["rows_written"])
+    family("cycles_total", "counter", "Cycles run since start", lambda s: s["cycles"])
+    family("skipped_total", "counter", "Cycles skipped because nothing changed", lambda s: s["skipped"])
+    family("errors_total", "counter", "Cycles that raised", lambda s: s["errors"])
+    family("gc_deleted_total", "counter", "Stale meta rows deleted by GC", lambda s: s["gc_deleted"])
+    family("last_cycle_timestamp_seconds", "gauge", "Unix time the last cycle finished", lambda s: s["last_cycle"], "{:.3f}")
+    out.append("# HELP winnet_supervisor_workers Worker processes")
+    out.append("# TYPE winnet_supervisor_workers gauge")
+    out.append(f"winnet_supervisor_workers {workers}")
+    return "\n".join(out) + "\n"
+
+
+def publish(args, status, holder, nworkers):
+    if args.status_file:
+        try:
+            sync_xui_sqlite.write_textfile(args.status_file, json.dumps(list(status.values()), indent=1))
+        except OSError as e:
+            print("[ERROR] status file:", e)
+    if args.metrics_file or args.metrics_port:
+        holder["text"] = render_status(status, nworkers)
+        if args.metrics_file:
+            try:
+                sync_xui_sqlite.write_textfile(args.metrics_file, holder["text"])
+            except OSError as e:
+                print("[ERROR] metrics file:", e)
+
+
+def supervise(args):
+    nworkers = max(1, args.workers)
+    results = mp.Queue()
+    workers = [None] * nworkers  # (process, task queue, heartbeat)
+
+    def start(i):
+        tasks = mp.Queue()
+        beat = mp.Value("d", 0.0, lock=False)
+        p = mp.Process(target=worker, args=(i, tasks, results, args, beat), daemon=True, name=f"winnet-sync-{i}")
+        p.start()
+        workers[i] = (p, tasks, beat)
+
+    for i in range(nworkers):
+        start(i)
+    status = {}    # path -> status dict
+    due = []       # heap of (monotonic time, path)
+    inflight = {}  # path -> worker id
+    holder = {}
+    killed = {}    # worker id -> why the watchdog killed it
+    if args.metrics_port:
+        sync_xui_sqlite.start_metrics_server(args.metrics_port, holder)
+    next_scan = 0.0
+    print(f"[INFO] supervisor workers={nworkers} interval={args.interval}s engines={','.join(args.engines)} apply={args.apply}")
+    try:
+        while True:
+            now = time.monotonic()
+            if now >= next_scan:
+                paths = discover(args)
+                for path in paths:
+                    if path not in status:
+                        # کم‌بارترین worker
+                        load = [0] * nworkers
+                        for s in status.values():
+                            load[s["worker"]] += 1
+                        status[path] = new_status(path, load.index(min(load)))
+                        heapq.heappush(due, (now, path))
+                        print(f"[INFO] + {path} (worker {status[path]['worker']})")
+                for path in [p for p in status if p not in paths]:
+                    workers[status[path]["worker"]][1].put(("drop", path))
+                    del status[path]
+                    print(f"[INFO] - {path}")
+                next_scan = now + args.rescan
+
+            while due and due[0][0] <= now:
+                _, path = heapq.heappop(due)
+                if path not in status or path in inflight:
+                    continue
+                wid = status[path]["worker"]
+                workers[wid][1].put(("cycle", path))
+                inflight[path] = wid
+
+            wait = min(1.0, max(0.0, next_scan - now), max(0.0, due[0][0] - now) if due else 1.0)
+            try:
+                res = results.get(timeout=wait)
+            except queue.Empty:
+                res = None
+            if res is not None:
+                path = res["db"]
+                inflight.pop(path, None)
+                s = status.get(path)
+                if s is not None:
+                    s["cycles"] += 1
+                    s["ok"] = res["ok"]
+                    s["cycle_seconds"] = res["seconds"]
+                    s["plans"] = res["plans"]
+                    s["rows_written"] = res["rows_written"]
+                    s["gc_deleted"] += res["gc_deleted"]
+                    s["last_cycle"] = time.time()
+                    if res["skipped"]:
+                        s["skipped"] += 1
+                    if res["ok"]:
+                        s["failures"] = 0
+                        s["error"] = ""
+                        delay = args.interval
+                    else:
+                        s["errors"] += 1
+                        s["failures"] += 1
+                        s["error"] = res["error"]
+                        delay = min(MAX_BACKOFF, args.interval * 2 ** min(s["failures"], 10))
+                        print(f"[ERROR] {path}: {res['error']} (retry in {delay}s)")
+                    heapq.heappush(due, (time.monotonic() + delay, path))
+                    if args.debug or res["plans"] or res["gc_deleted"]:
+                        for line in res["output"].splitlines():
+                            print(f"[{path}] {line}")
+                    publish(args, status, holder, nworkers)
+
+            # watchdog: backoff covers cycles that fail, not a worker stuck in one
+            if args.cycle_timeout > 0:
+                for i, (p, _, beat) in enumerate(workers):
+                    started = beat.value
+                    if started and time.time() - started > args.cycle_timeout and p.is_alive():
+                        print(f"[ERROR] worker {i} stuck in a task for over {args.cycle_timeout}s, killing it")
+                        killed[i] = f"cycle timed out after {args.cycle_timeout}s"
+                        p.kill()
+                        p.join(5)
+
+            for i, (p, _, _) in enumerate(workers):
+                if p.is_alive():
+                    continue
+                print(f"[ERROR] worker {i} exited with {p.exitcode}, restarting")
+                start(i)
+                why = killed.pop(i, "worker died")
+                for path in [q for q, w in inflight.items() if w == i]:
+                    del inflight[path]
+                    s = status.get(path)
+                    if s is not None:
+                        s["errors"] += 1
+                        s["failures"] += 1
+                        s["ok"] = False
+                        s["error"] = why
+                        heapq.heappush(due, (time.monotonic() + min(MAX_BACKOFF, args.interval * 2 ** min(s["failures"], 10)), path))
+    finally:
+        for p, tasks, _ in workers:
+            tasks.put(None)
+        for p, _, _ in workers:
+            p.join(5)
+
+
+def main():
+    ap = argparse.ArgumentParser(description="WinNet - Sync Supervisor")
+    ap.add_argument("--db", action="append", default=[], help="x-ui.db of one instance (repeatable)")
+    ap.add_argument("--discover", action="append", default=[], metavar="GLOB",
+                    help="glob matching instance databases, re-evaluated every --rescan seconds (repeatable)")
+    ap.add_argument("--rescan", type=int, default=60, help="seconds between --discover scans")
+    ap.add_argument("--workers", type=int, default=min(4, os.cpu_count() or 1), help="worker processes")
+    ap.add_argument("--interval", type=int, default=30, help="seconds between cycles of one database")
+    ap.add_argument("--cycle-timeout", type=int, default=CYCLE_TIMEOUT,
+                    help="kill and restart a worker whose cycle (or GC / backup) runs longer than this (0 = off)")
+    ap.add_argument("--engines", default="client,tunnel", help="comma separated: client,tunnel")
+    ap.add_argument("--apply", action="store_true")
+    ap.add_argument("--backup", action="store_true", help="with --apply: online backup of each database before applying")
+    ap.add_argument("--backup-interval", type=int, default=86400, help="seconds between backups (also across restarts)")
+    ap.add_argument("--backup-keep", type=int, default=5, help="backups to keep per database, 0 = all")
+    ap.add_argument("--backup-compress", action="store_true", help="gzip backups")
+    ap.add_argument("--gc-interval", type=int, default=sync_xui_sqlite.GC_INTERVAL,
+                    help="seconds between deletions of stale meta rows per database (0 = off)")
+    ap.add_argument("--gc-vacuum", type=int, default=0, metavar="PAGES",
+                    help="after GC, PRAGMA incremental_vacuum up to this many pages (needs auto_vacuum=INCREMENTAL)")
+    ap.add_argument("--init", action="store_true", help="seed the meta tables of every database and exit")
+    ap.add_argument("--debug", action="store_true")
+    ap.add_argument("--status-file", help="write per-database status as JSON here after every cycle")
+    ap.add_argument("--metrics-file", help="write Prometheus metrics here after every cycle (textfile collector)")
+    ap.add_argument("--metrics-port", type=int, help="serve Prometheus metrics on 127.0.0.1:PORT/metrics")
+    args = ap.parse_args()
+
+    args.engines = [e.strip() for e in args.engines.split(",") if e.strip()]
+    bad = [e for e in args.engines if e not in sync_xui_sqlite.ENGINES]
+    if bad or not args.engines:
+        print("[ERROR] unknown engine(s):", ",".join(bad) or "none")
+        return
+    if not args.db and not args.discover:
+        print("[ERROR] give at least one --db or --discover")
+        return
+
+    if args.init:
+        if "tunnel" in args.engines:
+            import sync_inbound_tunnel
+        for path in discover(args):
+            conn = sqlite3.connect(path, timeout=60)
+            try:
+                if "client" in args.engines:
+                    sync_xui_sqlite.ensure_seed(conn, debug=args.debug)
+                if "tunnel" in args.engines:
+                    sync_inbound_tunnel.ensure_seed(conn, debug=args.debug)
+                print("[INFO] seeded", path)
+            finally:
+                conn.close()
+        return
+    supervise(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,8 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 from __future__ import annotations
-import sqlite3, json, argparse, os, time, shutil, subprocess, re
+import sqlite3, json, argparse, os, sys, time, shutil, subprocess, re, hashlib, select, struct, ctypes, ctypes.util, threading, gzip, heapq, urllib.parse, marshal, zlib, functools, gc, signal
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 DB_DEFAULT = "/etc/x-ui/x-ui.db"
@@ -13,8 +14,61 @@ def jload(s):
 
 def jdump(o): return json.dumps(o, ensure_ascii=False, separators=(",", ":"))
 
-def ensure_meta(conn):
-    c=conn.cursor()
+# تنها فیلدهای کلاینت که sync لازم داره؛ بقیه (flow، tgId، fallbacks، ...) نگه داشته نمیشن
+CLIENT_FIELDS = ("subId", "subscription", "email", "id", "totalGB", "expiryTime", "limitIp", "comment", "updated_at")
+_KEEP = frozenset(CLIENT_FIELDS + ("clients",))
+
+def _keep_pairs(pairs):
+    return {k: v for k, v in pairs if k in _KEEP}
+
+def scan_clients(s):
+    """Compact records (dicts of CLIENT_FIELDS) for the clients of a raw
+    settings document.
+
+    Every object is cut down to the needed keys while it is being decoded,
+    so the full document (fallbacks, flow, ...) is never built; it is only
+    parsed with jload when an inbound is actually rewritten. Text jload
+    can't parse gives [].
+    """
+    try: doc = json.loads(s, object_pairs_hook=_keep_pairs)
+    except: return []
+    clients = doc.get("clients") if isinstance(doc, dict) else None
+    if not isinstance(clients, list): return []
+    return [c for c in clients if isinstance(c, dict)]
+
+def db_changed(conn, state):
+    """Cheap pre-check before a cycle: True if another connection committed
+    since the last cycle, or if our own last cycle wrote something."""
+    if state is None:
+        return True
+    ver = conn.execute("PRAGMA data_version").fetchone()[0]
+    prev = state.get("data_version")
+    state["data_version"] = ver
+    return prev is None or prev != ver or state.get("dirty", True)
+
+def chunks(seq, n=400):
+    """Split a list into slices small enough for SQLite's bound-parameter limit"""
+    for i in range(0, len(seq), n):
+        yield seq[i:i+n]
+
+def new_metrics(state):
+    """Per-cycle metrics dict, published as state["metrics"] for the exporter"""
+    m={"phases":{}, "rows_read":0, "groups_planned":0, "plans":0, "lock_wait":0.0, "skipped":0}
+    if state is not None: state["metrics"]=m
+    return m
+
+def lap(m, phase, t0):
+    """Add the time since t0 to a phase and return the new start time"""
+    t=time.perf_counter()
+    m["phases"][phase]=m["phases"].get(phase, 0.0)+(t-t0)
+    return t
+
+# --- schema: مهاجرت‌های نسخه‌دار، فقط یک بار موقع شروع ---
+def _add_column(c, table, col, decl):
+    if col not in {r[1] for r in c.execute(f"PRAGMA table_info({table})")}:
+        c.execute(f"ALTER TABLE {table} ADD COLUMN {col} {decl}")
+
+def _meta_v1(c):
     c.execute("""
     CREATE TABLE IF NOT EXISTS sync_meta_client(
       key TEXT PRIMARY KEY,
@@ -27,14 +81,54 @@ def ensure_meta(conn):
       raw_up INTEGER DEFAULT 0,
       raw_down INTEGER DEFAULT 0
     )""")
-    # Add columns if they don't exist (for existing installations)
-    try:
-        c.execute("ALTER TABLE sync_meta_client ADD COLUMN raw_up INTEGER DEFAULT 0")
-    except: pass
+    # نصب‌های قدیمی که جدول رو بدون raw_up/raw_down دارن
+    _add_column(c, "sync_meta_client", "raw_up", "INTEGER DEFAULT 0")
+    _add_column(c, "sync_meta_client", "raw_down", "INTEGER DEFAULT 0")
+
+def _meta_v2(c):
+    # signature JSON -> sig_hash
+    _add_column(c, "sync_meta_client", "sig_hash", "INTEGER")
+    rows = c.execute("SELECT key, signature FROM sync_meta_client WHERE signature IS NOT NULL").fetchall()
+    c.executemany("UPDATE sync_meta_client SET sig_hash=?, signature=NULL WHERE key=?",
+                  [(sig_digest(jload(sig)), k) for k, sig in rows])
+
+def _meta_v3(c):
+    _add_column(c, "sync_meta_client", "sql_fp", "TEXT")
+
+def _meta_v4(c):
+    c.execute("CREATE INDEX IF NOT EXISTS idx_sync_meta_client_sub ON sync_meta_client(subId)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_sync_meta_client_ct ON sync_meta_client(inbound_id, email)")
+
+# version n = the first n steps; only ever append. Every step also has to work
+# on a database from before versioning, where some of it may already be done.
+MIGRATIONS = (_meta_v1, _meta_v2, _meta_v3, _meta_v4)
+
+def migrate(conn, name, steps):
+    """Bring the schema of one engine (`name` in sync_schema) up to
+    len(steps). Up to date costs one SELECT and takes no write lock; the
+    pending steps otherwise run in one BEGIN IMMEDIATE transaction, after
+    checking the version again in case another process just migrated."""
+    c=conn.cursor()
+    def version():
+        try: r=c.execute("SELECT version FROM sync_schema WHERE name=?", (name,)).fetchone()
+        except sqlite3.OperationalError: return 0
+        return r[0] if r else 0
+    if version()>=len(steps): return
+    c.execute("BEGIN IMMEDIATE")
     try:
-        c.execute("ALTER TABLE sync_meta_client ADD COLUMN raw_down INTEGER DEFAULT 0")
-    except: pass
-    conn.commit()
+        c.execute("CREATE TABLE IF NOT EXISTS sync_schema(name TEXT PRIMARY KEY, version INTEGER NOT NULL)")
+        v=version()
+        for step in steps[v:]: step(c)
+        c.execute("INSERT OR REPLACE INTO sync_schema(name, version) VALUES(?,?)", (name, max(v, len(steps))))
+        conn.commit()
+    except Exception:
+        conn.rollback(); raise
+    if v<len(steps): print(f"[INFO] schema {name}: v{v} -> v{len(steps)}")
+
+def ensure_meta(conn):
+    """Migrate sync_meta_client to the current schema; called once per
+    connection at startup, never from the cycle"""
+    migrate(conn, "client", MIGRATIONS)
 
 def key_for(sub,iid,email,cid):
     k_id = (cid or "").strip()
@@ -54,36 +148,121 @@ def parse_multiplier(remark):
             pass
     return 1.0
 
-def load_inbounds(conn):
-    cur=conn.cursor()
-    cur.execute("SELECT id, settings, remark FROM inbounds")
-    rows=cur.fetchall()
+def client_keys(records):
+    """(subId, email, id, client) for every client that has a subscription"""
+    out=[]
+    for cl in records:
+        sub = cl.get("subId") or cl.get("subscription")
+        if not sub: continue
+        out.append((sub, cl.get("email") or "", cl.get("id") or "", cl))
+    return out
+
+def load_inbounds(conn, cache=None, rows=None, ids=None):
+    """Rows of (iid, records, remark, multiplier, client_keys), where records
+    are the compact client records from scan_clients().
+
+    cache is a dict kept across cycles by the loop: iid -> (tag, row). Only
+    inbounds whose raw settings text (or remark) changed are re-scanned.
+    rows: an already fetched (id, settings, remark, ...) snapshot to use
+    instead of querying. ids: only load these inbounds (the rest of the
+    cache is kept).
+    """
+    if ids is not None:
+        rows=[]
+        for part in chunks(sorted(ids)):
+            rows+=conn.execute(f"SELECT id, settings, remark FROM inbounds WHERE id IN ({','.join('?'*len(part))})", part).fetchall()
+    elif rows is None:
+        cur=conn.cursor()
+        cur.execute("SELECT id, settings, remark FROM inbounds")
+        rows=cur.fetchall()
     out=[]
-    for iid, s, remark in rows:
-        out.append((int(iid), jload(s), remark or ""))
+    fresh={}
+    for iid, s, remark, *_ in rows:
+        iid=int(iid); remark=remark or ""
+        tag=(len(s or ""), hash(s), remark)
+        hit=cache.get(iid) if cache is not None else None
+        if hit and hit[0]==tag:
+            row=hit[1]
+        else:
+            records=scan_clients(s)
+            row=(iid, records, remark, parse_multiplier(remark), client_keys(records))
+        fresh[iid]=(tag, row)
+        out.append(row)
+    if cache is not None:
+        # حذف inboundهای پاک شده از cache
+        if ids is None: cache.clear()
+        cache.update(fresh)
     return out
 
-def load_ct_map(conn):
+# رکوردهای فشرده به جای dict برای هر کلاینت؛ loop اون‌ها رو بین چرخه‌ها دوباره پر می‌کنه
+class CtRow:
+    """One client_traffics row"""
+    __slots__ = ("row_id", "inbound_id", "email", "up", "down", "quota_db", "expiry", "enable", "reset")
+    def __init__(self, row_id=None, inbound_id=0, email="", up=0, down=0, quota_db=0, expiry=0, enable=1, reset=0):
+        self.row_id=row_id; self.inbound_id=inbound_id; self.email=email; self.up=up; self.down=down
+        self.quota_db=quota_db; self.expiry=expiry; self.enable=enable; self.reset=reset
+    fill = __init__
+
+SIG_FIELDS = ("quota", "expiry", "comment", "limitIp", "used", "quota_db", "reset", "enable", "updated_at", "up", "down")
+
+class Sig:
+    """signature() result; items() keeps the field order sig_digest hashes"""
+    __slots__ = SIG_FIELDS
+    def items(self): return [(f, getattr(self, f)) for f in SIG_FIELDS]
+
+class MetaRow:
+    """sync_meta_client state of one entry from the previous cycle"""
+    __slots__ = ("sig_hash", "lc", "prev_raw_up", "prev_raw_down")
+    def __init__(self, sig_hash=None, lc=0, prev_raw_up=0, prev_raw_down=0):
+        self.sig_hash=sig_hash; self.lc=lc; self.prev_raw_up=prev_raw_up; self.prev_raw_down=prev_raw_down
+    fill = __init__
+
+NO_META = MetaRow()
+
+class Entry:
+    """One subscribed client of one inbound, as seen by the planner.
+    panel is the index of its database in multi-panel mode (0 otherwise)."""
+    __slots__ = ("sub", "iid", "email", "cid", "client", "ct", "sig", "key", "multiplier", "meta", "panel")
+    def __init__(self, sub=None, iid=0, email="", cid="", client=None, ct=None, sig=None, key="", multiplier=1.0, meta=NO_META, panel=0):
+        self.sub=sub; self.iid=iid; self.email=email; self.cid=cid; self.client=client
+        self.ct=ct; self.sig=sig; self.key=key; self.multiplier=multiplier; self.meta=meta; self.panel=panel
+    fill = __init__
+
+class Plan:
+    """Changes to bring one entry in line with its group's reference"""
+    __slots__ = ("sub", "iid", "email", "cid", "changes", "ref_sig", "ref_client", "reset_flag", "ref_updated", "target_up", "target_down", "ct", "panel", "client")
+    def __init__(self, sub, iid, email, cid, changes, ref_sig, ref_client, reset_flag, ref_updated, target_up, target_down, ct, panel=0, client=None):
+        self.sub=sub; self.iid=iid; self.email=email; self.cid=cid; self.changes=changes
+        self.ref_sig=ref_sig; self.ref_client=ref_client; self.reset_flag=reset_flag; self.ref_updated=ref_updated
+        self.target_up=target_up; self.target_down=target_down; self.ct=ct; self.panel=panel; self.client=client
+
+def load_ct_map(conn, cache=None):
+    """(inbound_id, email) -> CtRow. With cache (kept by the loop) the
+    CtRow objects of the previous cycle are refilled instead of reallocated."""
     cur=conn.cursor()
     cur.execute("SELECT id,inbound_id,email,up,down,total,expiry_time,enable,reset FROM client_traffics")
-    m={}
+    old=dict(cache) if cache else {}
+    m=cache if cache is not None else {}
+    m.clear()
     for rid,iid,email,up,down,total,expiry,enable,reset in cur.fetchall():
-        m[(int(iid),(email or ""))]={
-            "row_id":int(rid),
-            "inbound_id":int(iid),
-            "email":(email or ""),
-            "up":int(up or 0),
-            "down":int(down or 0),
-            "quota_db":int(total or 0),
-            "expiry":int(expiry or 0),
-            "enable":int(0 if enable in (0,"0",False) else 1),
-            "reset":int(reset or 0)
-        }
+        iid=int(iid); email=email or ""
+        vals=(int(rid), iid, email, int(up or 0), int(down or 0), int(total or 0), int(expiry or 0),
+              int(0 if enable in (0,"0",False) else 1), int(reset or 0))
+        r=old.pop((iid, email), None) or m.get((iid, email))
+        if r is None: r=CtRow(*vals)
+        else: r.fill(*vals)
+        m[(iid, email)]=r
     return m
 
+def same_ct(a, b):
+    """Two CtRow (or None) hold the same client_traffics row values"""
+    if a is None or b is None: return a is b
+    return (a.row_id, a.up, a.down, a.quota_db, a.expiry, a.enable, a.reset) == \
+           (b.row_id, b.up, b.down, b.quota_db, b.expiry, b.enable, b.reset)
+
 def used_from_ct(ct):
     if not ct: return 0
-    return int(ct.get("up") or 0) + int(ct.get("down") or 0)
+    return ct.up + ct.down
 
 def is_expired_by_date(expiry_val):
     """Check if client is expired by date"""
@@ -126,7 +305,8 @@ def should_be_enabled(client, ct):
     # Client should be enabled if not expired
     return not (expired_by_date or expired_by_traffic)
 
-def signature(client, ct):
+def signature(client, ct, out=None):
+    """Sig of a client and its traffic row; out is an old Sig to refill"""
     q = client.get("totalGB", None)
     try: quota = int(q) if q is not None else None
     except: quota = None
@@ -137,15 +317,20 @@ def signature(client, ct):
     try: limitIp = int(lim) if lim is not None else None
     except: limitIp = None
     used = used_from_ct(ct)
-    quota_db = int(ct.get("quota_db") if ct else 0)
-    enable = int(ct.get("enable") if ct else 1)
-    up_val = int(ct.get("up") if ct else 0)
-    down_val = int(ct.get("down") if ct else 0)
-    return {"quota": quota, "expiry": int(exp), "comment": comment,
-            "limitIp": limitIp, "used": int(used), "quota_db": int(quota_db),
-            "reset": int(ct.get("reset") if ct else 0), "enable": enable,
-            "updated_at": int(client.get("updated_at") or 0),
-            "up": up_val, "down": down_val}
+    s = out if out is not None else Sig()
+    s.quota = quota; s.expiry = int(exp); s.comment = comment; s.limitIp = limitIp
+    s.used = int(used); s.quota_db = int(ct.quota_db if ct else 0)
+    s.reset = int(ct.reset if ct else 0); s.enable = int(ct.enable if ct else 1)
+    s.updated_at = int(client.get("updated_at") or 0)
+    s.up = int(ct.up if ct else 0); s.down = int(ct.down if ct else 0)
+    return s
+
+def sig_digest(sig):
+    """Stable 64-bit digest of a signature; stored in sync_meta_client.sig_hash
+    so change detection is an integer compare instead of a JSON decode"""
+    if not sig: return None
+    h = hashlib.blake2b(repr(tuple(sig.items())).encode(), digest_size=8).digest()
+    return int.from_bytes(h, "big", signed=True)
 
 def ensure_seed(conn, debug=False):
     ensure_meta(conn)
@@ -154,162 +339,612 @@ def ensure_seed(conn, debug=False):
     inbs=load_inbounds(conn)
     cur=conn.cursor()
     n=0
-    for iid, settings, _remark in inbs:
-        for cl in settings.get("clients", []):
-            sub = cl.get("subId") or cl.get("subscription")
-            if not sub: continue
-            email = cl.get("email") or ""
-            cid = cl.get("id") or ""
+    for iid, _records, _remark, _mult, clients in inbs:
+        for sub, email, cid, cl in clients:
             ct_row = ct.get((iid, email))
             sig = signature(cl, ct_row)
             # ذخیره raw_up و raw_down هم برای delta calculation
-            raw_up = int(ct_row.get("up") or 0) if ct_row else 0
-            raw_down = int(ct_row.get("down") or 0) if ct_row else 0
-            cur.execute("INSERT OR REPLACE INTO sync_meta_client(key,subId,inbound_id,email,client_id,signature,last_change,raw_up,raw_down) VALUES(?,?,?,?,?,?,?,?,?)",
-                        (key_for(sub,iid,email,cid), sub, iid, email, cid, jdump(sig), now, raw_up, raw_down))
+            raw_up = ct_row.up if ct_row else 0
+            raw_down = ct_row.down if ct_row else 0
+            cur.execute("INSERT OR REPLACE INTO sync_meta_client(key,subId,inbound_id,email,client_id,sig_hash,last_change,raw_up,raw_down) VALUES(?,?,?,?,?,?,?,?,?)",
+                        (key_for(sub,iid,email,cid), sub, iid, email, cid, sig_digest(sig), now, raw_up, raw_down))
             n+=1
-            if debug: print("[SEED]", sub, iid, email, jdump(sig))
+            if debug: print("[SEED]", sub, iid, email, jdump(dict(sig.items())))
     conn.commit()
     if debug: print(f"[INFO] seeded {n} entries")
 
-def link_sub_by_uuid(conn, debug=False):
-    """Pre-sync: اکانت‌هایی که UUID مشترک دارن ولی subId ندارن، subId بگیرن"""
-    cur = conn.cursor()
-    cur.execute("SELECT id, settings FROM inbounds")
-    inbs = [(int(r[0]), jload(r[1])) for r in cur.fetchall()]
-    
-    # Group all clients by UUID across all inbounds
-    uuid_map = {}  # uuid -> [(iid, client_index, client, subId)]
-    for iid, settings in inbs:
-        for idx, cl in enumerate(settings.get("clients", [])):
+def link_sub_by_uuid(conn, debug=False, inbs=None, state=None, commit=True, defer=None):
+    """Pre-sync: اکانت‌هایی که UUID مشترک دارن ولی subId ندارن، subId بگیرن
+
+    The UUID index (uuid -> {iid: [(idx, client, subId)]}) lives in state and
+    is only refreshed for inbounds whose scanned clients changed; only UUIDs
+    seen in those inbounds are re-checked. Only inbounds that get a fix are
+    fully parsed, and each is written back with a single UPDATE.
+    defer: a list to append the write to (as a function of the writer's
+    connection) instead of writing on conn; the planned fix count is returned.
+    """
+    if inbs is None: inbs = load_inbounds(conn)
+    if state is not None:
+        index = state.setdefault("uuid_index", {})
+        seen = state.setdefault("uuid_seen", {})  # iid -> (records, uuids)
+    else:
+        index = {}; seen = {}
+
+    present = set()
+    touched = set()
+    for iid, records, *_ in inbs:
+        present.add(iid)
+        old = seen.get(iid)
+        if old and old[0] is records: continue
+        if old:
+            for uuid in old[1]:
+                g = index.get(uuid)
+                if g is not None:
+                    g.pop(iid, None)
+                    if not g: del index[uuid]
+        mine = {}
+        for idx, cl in enumerate(records):
             uuid = (cl.get("id") or "").strip()
             if not uuid: continue
             sub = (cl.get("subId") or cl.get("subscription") or "").strip()
-            uuid_map.setdefault(uuid, []).append((iid, idx, cl, sub))
-    
-    changes = 0
-    for uuid, clients in uuid_map.items():
+            mine.setdefault(uuid, []).append((idx, cl, sub))
+        for uuid, lst in mine.items():
+            index.setdefault(uuid, {})[iid] = lst
+        seen[iid] = (records, tuple(mine))
+        touched.update(mine)
+    for iid in [i for i in seen if i not in present]:
+        for uuid in seen.pop(iid)[1]:
+            g = index.get(uuid)
+            if g is not None:
+                g.pop(iid, None)
+                if not g: del index[uuid]
+    if not touched:
+        return 0
+
+    fixes = {}  # iid -> [(idx, uuid, subId)]
+    for uuid in touched:
+        g = index.get(uuid)
+        if not g: continue
+        # ترتیب مثل SELECT بدون ORDER BY (rowid = id) و بعد ترتیب کلاینت‌ها
+        clients = [(iid, idx, cl, sub) for iid in sorted(g) for idx, cl, sub in g[iid]]
         if len(clients) < 2: continue
-        
+
         # پیدا کردن subId غیرخالی (اولویت با اونی که داره)
         best_sub = ""
         for _, _, _, sub in clients:
             if sub:
                 best_sub = sub
                 break
-        
+
         if not best_sub: continue
-        
+
         # اعمال subId مشترک به همه
         for iid, idx, cl, sub in clients:
             if sub != best_sub:
-                cl["subId"] = best_sub
-                # Write back to DB
-                cur2 = conn.cursor()
-                cur2.execute("SELECT settings FROM inbounds WHERE id=?", (iid,))
-                r = cur2.fetchone()
-                s = jload(r[0] if r else "{}")
-                for c in s.get("clients", []):
-                    if (c.get("id") or "") == uuid:
-                        c["subId"] = best_sub
-                        break
-                cur2.execute("UPDATE inbounds SET settings=? WHERE id=?", (jdump(s), iid))
-                changes += 1
+                fixes.setdefault(iid, []).append((idx, uuid, best_sub))
                 if debug:
                     print(f"[LINK] UUID={uuid[:8]}... iid={iid} subId set to {best_sub}")
-    
+    if not fixes:
+        return 0
+    if defer is not None:
+        defer.append(lambda c: write_links(c, fixes, debug))
+        return sum(map(len, fixes.values()))
+    changes, updates = write_links(conn, fixes, debug, commit)
+    if changes and state is not None:
+        # رکوردهای این inboundها کهنه شدن؛ دفعه بعد از دیتابیس scan بشن
+        for _, iid in updates: state.get("inbounds", {}).pop(iid, None)
+    return changes
+
+SETTINGS_RETRIES = 3  # re-reads of an inbound (or group) whose settings changed under a rewrite
+
+def write_links(conn, fixes, debug=False, commit=False):
+    """Write link_sub_by_uuid() fixes (iid -> [(idx, uuid, subId)]) against
+    the current settings; returns (clients changed, [(settings, iid)]).
+
+    Every rewrite is guarded by the blob it was made from (AND settings=?):
+    an inbound that x-ui rewrote in between is re-read and fixed again on
+    its own, up to SETTINGS_RETRIES times."""
+    updates = []
+    changes = 0
+    todo = sorted(fixes)
+    for attempt in range(SETTINGS_RETRIES + 1):
+        lost = []
+        for part in chunks(todo):
+            rows = conn.execute(f"SELECT id, settings FROM inbounds WHERE id IN ({','.join('?'*len(part))})", part).fetchall()
+            for iid, raw in rows:
+                # فقط inboundهایی که فیکس دارن کامل parse و بازنویسی میشن
+                settings = jload(raw)
+                cls = settings.get("clients", [])
+                n = 0
+                for idx, uuid, best_sub in fixes[int(iid)]:
+                    # اگه x-ui همین الان آرایه رو عوض کرده، کلاینت دیگه‌ای رو دست نزن
+                    if idx < len(cls) and (cls[idx].get("id") or "").strip() == uuid:
+                        cls[idx]["subId"] = best_sub
+                        n += 1
+                if not n: continue
+                new = jdump(settings)
+                if conn.execute("UPDATE inbounds SET settings=? WHERE id=? AND settings IS ?", (new, int(iid), raw)).rowcount:
+                    updates.append((new, int(iid)))
+                    changes += n
+                else:
+                    lost.append(int(iid))
+        if not lost: break
+        if debug: print(f"[LINK] settings of {len(lost)} inbound(s) changed while linking, retrying them")
+        todo = lost
     if changes:
-        conn.commit()
+        if commit: conn.commit()
         if debug: print(f"[INFO] linked {changes} clients by UUID")
-    return changes
+    return changes, updates
 
-def sync_once(conn, apply=False, debug=False):
-    ensure_meta(conn)
+SETTINGS_CHANGES = ("quota", "limitIp", "expiry", "comment", "uuid")
+
+def index_clients(clients):
+    """(subId, email) -> the first client record with that pair"""
+    d={}
+    for c in clients:
+        d.setdefault((c.get("subId") or c.get("subscription"), c.get("email") or ""), c)
+    return d
+
+def edit_client(s, p, touch=False):
+    """Write p's settings changes into its client in the parsed settings s
+    and move its updated_at to the reference's (with touch also when no
+    other field changes, for a traffic-only plan); True if s changed"""
+    ch=p.changes
+    for c in s.get("clients", []):
+        if (c.get("email") or "")!=p.email or (c.get("subId") or c.get("subscription"))!=p.sub: continue
+        changed=False
+        if "quota" in ch and "totalGB" in c:
+            c["totalGB"]=int(ch["quota"][1]); changed=True
+        if "limitIp" in ch:
+            c["limitIp"]=int(ch["limitIp"][1]); changed=True
+        if "expiry" in ch:
+            c["expiryTime"]=int(ch["expiry"][1]); changed=True
+        if "comment" in ch:
+            c["comment"]=ch["comment"][1]; changed=True
+        if "uuid" in ch:
+            c["id"]=ch["uuid"][1]; changed=True
+        if not changed and touch:
+            try: changed=int(c.get("updated_at") or 0)!=int(p.ref_updated or 0)
+            except (TypeError, ValueError): changed=True
+        if changed:
+            c["updated_at"]=int(p.ref_updated or int(time.time() * 1000))
+        return changed
+    return False
+
+class SettingsDoc:
+    """One inbound's settings as apply_plans() sees them: the blob in the
+    table, its compact records, the parsed document once a plan edits it
+    (dirty until written back) and the plans whose meta rows still carry
+    the signature of the blob, to be redone when the document is written"""
+    __slots__ = ("raw", "compact", "doc", "dirty", "pending")
+    def __init__(self, raw):
+        self.raw=raw; self.compact=None; self.doc=None; self.dirty=False; self.pending=[]
+    def lookup(self):
+        if self.compact is None: self.compact=index_clients(scan_clients(self.raw))
+        return self.compact
+    def parsed(self):
+        if self.doc is None: self.doc=jload(self.raw)
+        return self.doc
+
+def apply_plans(conn, plans, m, cas=None, cas_ct=False, cas_blobs=None, docs=None, flush=None):
+    """Write a list of plans inside the caller's transaction.
+
+    Everything is read up front (settings of the touched inbounds, the
+    needed client_traffics rows), the new values are worked out in memory
+    and flushed with executemany; meta signatures are recomputed from the
+    written values. Returns (settings_updated, traffic_rows_written).
+
+    cas: a set; when given, a group with a member whose client record
+    (and with cas_ct its traffic row too) no longer matches what it was
+    planned from is skipped and its subId added to cas, so an edit made in
+    the panel since the cycle's read is never overwritten. Settings are
+    written back guarded by the blob read here.
+
+    cas_blobs: iid -> settings blob the plans were made from, for planners
+    that never built the client records (sync_once_sql); the inbound's
+    blob is compared instead of the member's record.
+
+    docs / flush: kept by apply_chunked() across its chunks. docs (iid ->
+    SettingsDoc) holds every inbound read so far, so a later chunk only
+    checks its blob is unchanged instead of reading and parsing it again;
+    an edited document is written once, in the chunk that has its iid in
+    flush (None = this one). Until then the meta rows of its members get
+    the signature of the blob still in the table, so a cycle cut short in
+    between leaves meta and data in step and the group is planned again.
+    """
+    t=time.perf_counter()
+    cur=conn.cursor()
+    if docs is None: docs={}
+    iids=sorted({p.iid for p in plans})
+    for iid in [i for i in iids if i in docs]:
+        r=cur.execute("SELECT settings IS ? FROM inbounds WHERE id=?", (docs[iid].raw, iid)).fetchone()
+        if not (r and r[0]):
+            # x-ui بین دو chunk بازنویسیش کرده: ویرایش‌های نوشته‌نشده کنار میرن؛ meta با جدول می‌خونه
+            # و گروه‌هایی که plan داشتن چرخه بعد دوباره plan میشن
+            lost=docs.pop(iid)
+            m["cas_conflicts"]=m.get("cas_conflicts", 0)+len({p.sub for p, *_ in lost.pending})
+    todo=[i for i in iids if i not in docs]
+    for part in chunks(todo):
+        cur.execute(f"SELECT id, settings FROM inbounds WHERE id IN ({','.join('?'*len(part))})", part)
+        for rid, raw in cur.fetchall():
+            docs[int(rid)]=SettingsDoc(raw)
+    for iid in todo:
+        if iid not in docs: docs[iid]=SettingsDoc(None)
+
+    # (iid, email) -> ردیف client_traffics، بعد از هر plan با مقادیر جدید به‌روز میشه
+    ct_rows={}
+    ct_pairs=sorted({(p.iid, p.email) for p in plans})
+    for part in chunks(ct_pairs):
+        cur.execute("SELECT id,inbound_id,email,up,down,total,expiry_time,enable,reset FROM client_traffics "
+                    f"WHERE (inbound_id, email) IN (VALUES {','.join(['(?,?)']*len(part))})",
+                    [v for pair in part for v in pair])
+        for rid, riid, remail, up0, down0, tot0, exp0, en0, reset0 in cur.fetchall():
+            ct_rows.setdefault((int(riid), remail or ""), CtRow(
+                int(rid), int(riid), remail or "", int(up0 or 0), int(down0 or 0), int(tot0 or 0), int(exp0 or 0),
+                int(0 if en0 in (0,"0",False) else 1), int(reset0 or 0)))
+    m["rows_read"]+=len(todo)+len(ct_rows)
+    if cas is not None:
+        if cas_blobs is not None:
+            moved=lambda p: docs[p.iid].raw != cas_blobs.get(p.iid)
+        else:
+            moved=lambda p: docs[p.iid].lookup().get((p.sub, p.email)) != p.client
+        bad={p.sub for p in plans if moved(p) or (cas_ct and not same_ct(ct_rows.get((p.iid, p.email)), p.ct))}
+        if bad:
+            cas.update(bad)
+            m["cas_conflicts"]=m.get("cas_conflicts", 0)+len(bad)
+            plans=[p for p in plans if p.sub not in bad]
+
+    ct_writes=0; set_writes=0
+    ct_final={}  # (iid, email) -> مقادیر نوشته شده در client_traffics
+    for p in plans:
+        iid=p.iid; email=p.email; ch=p.changes; d=docs[iid]
+
+        need_ct = any(k in ch for k in ("used","expiry","quota_db","enable","up_down"))
+        if need_ct:
+            row=ct_rows.get((iid, email))
+            rid=None; up0=0; down0=0; tot0=0; exp0=0; en0=1; reset0=0
+            if row:
+                rid=row.row_id; up0=row.up; down0=row.down; tot0=row.quota_db
+                exp0=row.expiry; en0=row.enable; reset0=row.reset
+
+            # استفاده از target_up و target_down
+            if "up_down" in ch:
+                new_up = p.target_up
+                new_down = p.target_down
+            else:
+                new_up = up0
+                new_down = down0
+
+            new_quota_db = tot0
+            if "quota_db" in ch:
+                new_quota_db = int(ch["quota_db"][1])
+            
+            # اطمینان از اینکه quota_db از مجموع up+down کمتر نباشد
+            total_used = new_up + new_down
+            if new_quota_db > 0 and new_quota_db < total_used:
+                new_quota_db = total_used
+
+            new_expiry = exp0
+            if "expiry" in ch:
+                new_expiry = int(ch["expiry"][1])
+
+            new_enable = en0
+            if "enable" in ch:
+                new_enable = int(ch["enable"][1])
+
+            # row_id=None یعنی ردیف جدیده و موقع flush اضافه میشه
+            ct_rows[(iid, email)] = CtRow(rid, iid, email, new_up, new_down, new_quota_db, new_expiry, new_enable, 0)
+            ct_writes+=1
+            ct_final[(iid, email)] = ct_rows[(iid, email)]
+
+        # updated_at کلاینت هم باید با reference بخونه؛ سند کامل فقط وقتی parse میشه که لازمه
+        edit = any(k in ch for k in SETTINGS_CHANGES)
+        if not edit and need_ct:
+            if d.doc is not None: edit = True
+            else:
+                cc = d.lookup().get((p.sub, p.email))
+                try: edit = cc is not None and int(cc.get("updated_at") or 0) != int(p.ref_updated or 0)
+                except (TypeError, ValueError): edit = True
+        if edit and edit_client(d.parsed(), p, touch=need_ct):
+            d.dirty=True
+            set_writes+=1
+
+    # --- FLUSH: هر ردیف ترافیک یک بار، و هر inbound فقط یک بار در کل apply_chunked ---
+    ct_updates=[]; ct_inserts=[]
+    for (iid, email), r in ct_final.items():
+        if r.row_id:
+            ct_updates.append((r.up, r.down, r.quota_db, r.expiry, r.enable, r.row_id))
+        else:
+            ct_inserts.append((iid, r.enable, email, r.up, r.down, r.expiry, r.quota_db))
+    if ct_updates:
+        cur.executemany("UPDATE client_traffics SET up=?,down=?,total=?,expiry_time=?,enable=?,reset=0 WHERE id=?", ct_updates)
+    if ct_inserts:
+        cur.executemany("INSERT INTO client_traffics(inbound_id,enable,email,up,down,expiry_time,total,reset) VALUES(?,?,?,?,?,?,?,0)", ct_inserts)
+    written=sorted(i for i in (iids if flush is None else flush) if i in docs and docs[i].dirty)
+    for iid in written:
+        d=docs[iid]
+        new=jdump(d.doc)
+        # داخل همون تراکنشی که blob رو چک کردیم؛ اگه نخونه یعنی کسی وسطش نوشته و کل chunk برمی‌گرده
+        if not cur.execute("UPDATE inbounds SET settings=? WHERE id=? AND settings IS ?", (new, iid, d.raw)).rowcount:
+            raise sqlite3.OperationalError(f"settings of inbound {iid} changed during the write")
+        d.raw=new; d.compact=None; d.dirty=False
+        # chunk بعدی همین inbound نوشته‌ی خودمون رو conflict حساب نکنه
+        if cas_blobs is not None: cas_blobs[iid]=new
+    t=lap(m, "apply", t)
+
+    # --- RECOMPUTE signatures in memory from the values just written ---
+    # inboundی که الان نوشته شد از سند parse شده، بقیه از رکوردهای فشرده‌ی blob توی جدول
+    written=set(written)
+    now=int(time.time())
+    lookups={}
+    def meta_row(p, ct_row):
+        lookup = lookups.get(p.iid)
+        if lookup is None:
+            d = docs[p.iid]
+            lookup = lookups[p.iid] = index_clients(d.doc.get("clients", [])) if p.iid in written else d.lookup()
+        client_obj = lookup.get((p.sub, p.email))
+        if not client_obj:
+            ref_sig = p.ref_sig
+            client_obj = {
+                "totalGB": ref_sig.quota,
+                "expiryTime": ref_sig.expiry,
+                "comment": ref_sig.comment,
+                "limitIp": ref_sig.limitIp
+            }
+        new_sig = signature(client_obj, ct_row)
+        # ذخیره signature جدید به همراه مقادیر raw جدید (بعد از سینک)
+        return (sig_digest(new_sig), now, ct_row.up, ct_row.down, key_for(p.sub, p.iid, p.email, p.cid))
+    meta_rows=[]
+    for p in plans:
+        ct_row = ct_final.get((p.iid, p.email)) or p.ct or CtRow()
+        row = meta_row(p, ct_row)
+        meta_rows.append(row)
+        d = docs[p.iid]
+        if d.dirty and p.iid not in written: d.pending.append((p, ct_row, row[0]))
+    for iid in written:
+        # plan های chunk های قبل که signature رو از blob قدیمی گرفتن، اگه سند عوضش کرده
+        for p, ct_row, old in docs[iid].pending:
+            row = meta_row(p, ct_row)
+            if row[0] != old: meta_rows.append(row)
+        docs[iid].pending=[]
+    cur.executemany("UPDATE sync_meta_client SET sig_hash=?, last_change=?, raw_up=?, raw_down=? WHERE key=?", meta_rows)
+    lap(m, "recompute", t)
+    return set_writes, ct_writes
+
+APPLY_CHUNK = 500        # plans per write transaction (whole groups, so a big group may exceed it)
+LOCK_SLOW = 0.05         # waiting longer than this for BEGIN IMMEDIATE means x-ui is busy
+LOCK_RETRIES = 5
+LOCK_BACKOFF_MAX = 2.0
+
+def apply_chunked(conn, plans, m, state=None, cas=None, cas_ct=False, cas_blobs=None, pre=None):
+    """Apply plans in short transactions of about APPLY_CHUNK plans, never
+    splitting a subscription group, each taking the write lock with BEGIN
+    IMMEDIATE. When the lock wait shows x-ui is writing, the chunk size is
+    halved (and remembered in state) and we pause before the next chunk;
+    quick acquisitions grow it back.
+
+    An inbound's settings are read and parsed once for all chunks and
+    written once, in the chunk holding the last group that touches it.
+    pre: writes (fn(conn)) done first in the first chunk's transaction,
+    which is then taken even with no plans."""
+    sched = state.setdefault("write_sched", {"chunk": APPLY_CHUNK}) if state is not None else {"chunk": APPLY_CHUNK}
+    groups={}
+    for p in plans: groups.setdefault(p.sub, []).append(p)
+    pending=list(groups.values()); pos=0
+    last={p.iid: n for n, g in enumerate(pending) for p in g}
+    docs={}
+    set_writes=ct_writes=0
+    while pos < len(pending) or pre:
+        batch=[]
+        while pos < len(pending) and (not batch or len(batch)+len(pending[pos]) <= sched["chunk"]):
+            batch.extend(pending[pos]); pos+=1
+        for attempt in range(LOCK_RETRIES):
+            tl=time.perf_counter()
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                wait=time.perf_counter()-tl; m["lock_wait"]+=wait
+                break
+            except sqlite3.OperationalError as e:
+                m["lock_wait"]+=time.perf_counter()-tl
+                if "locked" not in str(e) and "busy" not in str(e): raise
+                sched["chunk"]=max(1, sched["chunk"]//2)
+                tb=time.perf_counter(); time.sleep(min(LOCK_BACKOFF_MAX, 0.1*2**attempt)); lap(m, "backoff", tb)
+        else:
+            raise sqlite3.OperationalError("database is locked: gave up waiting for the write lock")
+        try:
+            for fn in pre or (): fn(conn)
+            pre=None
+            sw, cw = apply_plans(conn, batch, m, cas, cas_ct, cas_blobs, docs, {p.iid for p in batch if last[p.iid] < pos}) if batch else (0, 0)
+            tc=time.perf_counter(); conn.commit(); lap(m, "commit", tc)
+        except Exception:
+            conn.rollback(); raise
+        set_writes+=sw; ct_writes+=cw
+        m["chunks"]=m.get("chunks", 0)+1
+        if wait > LOCK_SLOW:
+            sched["chunk"]=max(1, sched["chunk"]//2)
+            if pos < len(pending):
+                tb=time.perf_counter(); time.sleep(min(LOCK_BACKOFF_MAX, wait)); lap(m, "backoff", tb)
+        elif sched["chunk"] < APPLY_CHUNK:
+            sched["chunk"]=min(APPLY_CHUNK, sched["chunk"]*2)
+    return set_writes, ct_writes
+
+def write_meta_cas(conn, upserts):
+    """Meta upserts from a snapshot (rows as in collect_entries, ending with
+    the sig_hash they replace): a row that changed since is left alone"""
+    conn.executemany("UPDATE sync_meta_client SET subId=?,inbound_id=?,email=?,client_id=?,sig_hash=?,last_change=?,raw_up=?,raw_down=? "
+                     "WHERE key=? AND sig_hash IS ?", [u[1:9] + (u[0], u[9]) for u in upserts if u[9] is not None])
+    conn.executemany("INSERT OR IGNORE INTO sync_meta_client(key,subId,inbound_id,email,client_id,sig_hash,last_change,raw_up,raw_down) VALUES(?,?,?,?,?,?,?,?,?)",
+                     [u[:9] for u in upserts if u[9] is None])
+
+STALE_SIG = 0  # sig_hash that no signature digests to: the row is upserted again next cycle
+
+def restore_raw(conn, groups, subs, panel=None):
+    """A group skipped by compare-and-swap keeps the traffic baseline it
+    was planned with: this cycle's meta upserts already moved raw_up /
+    raw_down to the current counters, so without this its deltas would
+    never be counted. Only members whose counters moved are touched; their
+    sig_hash is marked stale so the next cycle upserts the row again and
+    moves raw forward once the group is written. panel: only the members
+    of that panel."""
+    rows=[(e.meta.prev_raw_up, e.meta.prev_raw_down, STALE_SIG, e.key) for sub in subs for e in groups.get(sub, ())
+          if (panel is None or e.panel==panel) and e.ct and (e.ct.up, e.ct.down)!=(e.meta.prev_raw_up, e.meta.prev_raw_down)]
+    if rows:
+        conn.executemany("UPDATE sync_meta_client SET raw_up=?, raw_down=?, sig_hash=? WHERE key=?", rows)
+        conn.commit()
+
+def apply_guarded(conn, plans, groups, m, state=None, debug=False, cas_ct=False, cas_blobs=None, pre=None):
+    """apply_chunked() with compare-and-swap against the read the plans were
+    made from. A group with a member edited in the panel since then is
+    reloaded from just its inbounds, planned again and retried, up to
+    SETTINGS_RETRIES times, instead of waiting for the next full cycle;
+    whatever still conflicts is left to the next cycle (state["replan"]).
+    cas_ct / cas_blobs / pre apply to the first write (see apply_plans and
+    apply_chunked); the retries are planned from records read right before
+    them."""
+    cas=set()
+    set_writes, ct_writes = apply_chunked(conn, plans, m, state, cas=cas, cas_ct=cas_ct, cas_blobs=cas_blobs, pre=pre)
+    for attempt in range(SETTINGS_RETRIES):
+        if not cas: break
+        m["retries"]=m.get("retries", 0)+1
+        if debug: print(f"[RETRY] {len(cas)} group(s) changed since they were read, re-planning them")
+        iids={e.iid for sub in cas for e in groups.get(sub, ())}
+        base={e.key: e.meta for sub in cas for e in groups.get(sub, ())}
+        groups, _ = reload_groups(conn, cas, iids, m, state.get("inbounds") if state is not None else None, base)
+        cas=set()
+        plans=plan_groups(groups)
+        if plans:
+            sw, cw = apply_chunked(conn, plans, m, state, cas=cas)
+            set_writes+=sw; ct_writes+=cw
+    if cas:
+        restore_raw(conn, groups, cas)
+        if state is not None:
+            state.setdefault("replan", set()).update(cas)
+            state["dirty"]=True
+    return set_writes, ct_writes
+
+def collect_entries(conn, m, debug=False, state=None, snapshot=None, commit=True, panel=0, defer=None, pipelined=False):
+    """Load side of a client cycle for one database: scan inbounds, link
+    subIds by UUID, load traffic and meta rows and record signature changes.
+
+    Returns (entries, dirty_subs, plan_all, changed): dirty_subs are the
+    subIds with a changed, added or removed member, plan_all means there is
+    no previous cycle to compare with, changed that something was written.
+
+    defer: a list the meta upserts are appended to, as functions of the
+    connection that writes them (write_meta_cas).
+    pipelined: conn is a read-only snapshot whose writes run later on the
+    writer thread; UUID links are deferred too and after a link nothing is
+    planned until the next cycle.
+    """
+    t=time.perf_counter()
+    inb_cache = state.setdefault("inbounds", {}) if state is not None else None
+    inbs=load_inbounds(conn, cache=inb_cache, rows=snapshot["inbounds"] if snapshot else None)
+    m["rows_read"]+=len(inbs)
+    t=lap(m, "load", t)
     # Pre-sync: لینک subId از طریق UUID مشترک
-    link_sub_by_uuid(conn, debug=debug)
+    linked = link_sub_by_uuid(conn, debug=debug, inbs=inbs, state=state, commit=commit, defer=defer if pipelined else None)
+    if linked and pipelined:
+        return [], set(), False, True
+    if linked:
+        # فقط inboundهایی که بازنویسی شدن دوباره parse میشن
+        inbs=load_inbounds(conn, cache=inb_cache)
+    t=lap(m, "link", t)
     cur=conn.cursor()
-    ct=load_ct_map(conn)
-    inbs=load_inbounds(conn)
+    # CtRow / MetaRow / Entry های چرخه قبل دوباره پر میشن، نه ساخته
+    # pipelined: رکوردها به plan‌هایی میرسن که writer بعدا می‌نویسه؛ دوباره پر نمیشن
+    reuse = state is not None and not pipelined
+    ct=load_ct_map(conn, cache=state.setdefault("ct", {}) if reuse else None)
+    m["rows_read"]+=len(ct)
+    t=lap(m, "load", t)
 
     # Load meta with raw values from previous cycle
-    cur.execute("SELECT key,signature,last_change,raw_up,raw_down FROM sync_meta_client")
-    meta_map={}
-    for row in cur.fetchall():
-        k, sig, lc, raw_up, raw_down = row
-        meta_map[k] = {
-            "sig": json.loads(sig) if sig else {},
-            "lc": int(lc or 0),
-            "prev_raw_up": int(raw_up or 0),
-            "prev_raw_down": int(raw_down or 0)
-        }
+    cur.execute("SELECT key,sig_hash,last_change,raw_up,raw_down FROM sync_meta_client")
+    meta_map=state.setdefault("meta", {}) if state is not None else {}
+    old_meta=dict(meta_map); meta_map.clear()
+    for k, sig_hash, lc, raw_up, raw_down in cur.fetchall():
+        vals=(sig_hash, int(lc or 0), int(raw_up or 0), int(raw_down or 0))
+        r=old_meta.pop(k, None)
+        if r is None: r=MetaRow(*vals)
+        else: r.fill(*vals)
+        meta_map[k]=r
+    del old_meta
+    m["rows_read"]+=len(meta_map)
     now=int(time.time())
     upserts=[]
 
     entries=[]
-    for iid, settings, remark in inbs:
-        multiplier = parse_multiplier(remark)
-        for cl in settings.get("clients", []):
-            sub = cl.get("subId") or cl.get("subscription")
-            if not sub: continue
-            email = cl.get("email") or ""
-            cid = cl.get("id") or ""
+    prev_entries={e.key: e for e in state.get("entries", ())} if reuse else {}
+    seen_keys={}  # key -> subId
+    dirty_subs=set()  # subIdهایی که حداقل یک عضوشون تغییر کرده
+    for iid, _records, _remark, multiplier, clients in inbs:
+        for sub, email, cid, cl in clients:
             k = key_for(sub, iid, email, cid)
+            # کلید تکراری در همین چرخه Entry جدا می‌گیره
+            e = prev_entries.get(k) if k not in seen_keys else None
+            if e is None: e = Entry()
+            seen_keys[k] = sub
             ct_row = ct.get((iid, email))
-            sig = signature(cl, ct_row)
+            sig = signature(cl, ct_row, e.sig)
+            sig_hash = sig_digest(sig)
             old = meta_map.get(k)
-            old_sig = old.get("sig") if old else None
-            # حفظ مقادیر prev_raw از دیتابیس (چرخه قبل) برای محاسبه delta
-            old_prev_up = old.get("prev_raw_up", 0) if old else 0
-            old_prev_down = old.get("prev_raw_down", 0) if old else 0
-            if (old_sig and old_sig != sig) or (k not in meta_map):
+            old_hash = old.sig_hash if old else None
+            if (old_hash is not None and old_hash != sig_hash) or (k not in meta_map):
                 # Store current raw up/down values (before sync overwrites them) - for NEXT cycle
-                cur_up = int(ct_row.get("up") or 0) if ct_row else 0
-                cur_down = int(ct_row.get("down") or 0) if ct_row else 0
-                upserts.append((k, sub, iid, email, cid, jdump(sig), now, cur_up, cur_down))
+                cur_up = ct_row.up if ct_row else 0
+                cur_down = ct_row.down if ct_row else 0
+                upserts.append((k, sub, iid, email, cid, sig_hash, now, cur_up, cur_down, old_hash))
                 # مهم: فقط sig و lc آپدیت میشه، prev_raw ها از دیتابیس میان (برای delta فعلی)
-                meta_map[k] = {"sig": sig, "lc": now, "prev_raw_up": old_prev_up, "prev_raw_down": old_prev_down}
+                if old: old.sig_hash = sig_hash; old.lc = now
+                else: meta_map[k] = MetaRow(sig_hash, now, 0, 0)
+                dirty_subs.add(sub)
                 if debug:
-                    print("[META] change", k, "->", sig)
-            entries.append({"sub":sub,"iid":iid,"email":email,"cid":cid,"client":cl,"ct":ct_row,"sig":sig,"key":k,"multiplier":multiplier})
+                    print("[META] change", k, "->", dict(sig.items()))
+            e.fill(sub, iid, email, cid, cl, ct_row, sig, k, multiplier, meta_map[k], panel)
+            entries.append(e)
+    if state is not None:
+        state["entries"] = entries
 
-    if upserts:
-        for row in upserts:
-            cur.execute("INSERT OR REPLACE INTO sync_meta_client(key,subId,inbound_id,email,client_id,signature,last_change,raw_up,raw_down) VALUES(?,?,?,?,?,?,?,?,?)", row)
-        conn.commit()
+    if upserts and defer is not None:
+        defer.append(lambda c: write_meta_cas(c, upserts))
+    elif upserts:
+        cur.executemany("INSERT OR REPLACE INTO sync_meta_client(key,subId,inbound_id,email,client_id,sig_hash,last_change,raw_up,raw_down) VALUES(?,?,?,?,?,?,?,?,?)",
+                        [u[:9] for u in upserts])
+        if commit: conn.commit()
         if debug: print(f"[INFO] meta updated {len(upserts)}")
+    t=lap(m, "meta", t)
 
-    groups={}
-    for e in entries:
-        groups.setdefault(e["sub"], []).append(e)
+    # Dirty-group planner: گروهی که هیچ عضوش تغییر نکرده، حذف/اضافه نشده و
+    # چرخه قبل plan نداشته، همون ورودی‌های چرخه قبل رو داره و plan جدیدی نمیده
+    plan_all = state is None or "keys" not in state
+    if not plan_all:
+        prev_keys = state["keys"]
+        for k, sub in prev_keys.items():
+            if k not in seen_keys: dirty_subs.add(sub)
+        for k, sub in seen_keys.items():
+            if k not in prev_keys: dirty_subs.add(sub)
+    if state is not None:
+        state["keys"] = seen_keys
+    return entries, dirty_subs, plan_all, bool(linked or upserts)
 
+def plan_groups(groups):
+    """Plans for subscription groups (subId -> [Entry]): the member with the
+    newest last_change is the reference, traffic is merged from the per
+    member deltas since the previous cycle."""
     plans=[]
     for sub, items in groups.items():
         with_lc=[]
         for e in items:
-            k=key_for(sub, e["iid"], e["email"], e["cid"])
-            meta_entry = meta_map.get(k, {})
-            lc = meta_entry.get("lc", 0)
+            meta_entry = e.meta
+            lc = meta_entry.lc
             with_lc.append((lc, e, meta_entry))
         if not with_lc: continue
         with_lc.sort(key=lambda t:t[0], reverse=True)
         ref = with_lc[0][1]
-        ref_sig = ref["sig"]
-        ref_client = ref["client"]
+        ref_sig = ref.sig
+        ref_client = ref.client
         # determine reference updated_at (ms) from the reference inbound client settings
+        # ref_client از همین snapshot inbounds میاد، خوندن دوباره settings لازم نیست
         ref_updated = int(ref_client.get("updated_at") or 0)
-        if not ref_updated:
-            # try to get updated_at from the inbounds table for the reference inbound
-            try:
-                cur.execute("SELECT settings FROM inbounds WHERE id=?", (ref["iid"],))
-                rr = cur.fetchone()
-                if rr and rr[0]:
-                    ss = jload(rr[0])
-                    for cc in ss.get("clients", []):
-                        if (cc.get("subId") or cc.get("subscription")) == (ref_client.get("subId") or ref_client.get("subscription")) and ((cc.get("email") or "") == (ref_client.get("email") or "")):
-                            ref_updated = int(cc.get("updated_at") or 0)
-                            break
-            except Exception:
-                ref_updated = 0
         if not ref_updated:
             ref_updated = int(time.time() * 1000)
 
@@ -321,18 +956,17 @@ def sync_once(conn, apply=False, debug=False):
         total_delta_down = 0
         
         # پیدا کردن مقدار پایه از reference
-        ref_ct = ref.get("ct") or {}
+        ref_ct = ref.ct
         ref_meta = with_lc[0][2]  # meta entry for reference
-        ref_multiplier = ref.get("multiplier", 1.0)  # ضریب reference
-        ref_prev_up = ref_meta.get("prev_raw_up", 0)
-        ref_prev_down = ref_meta.get("prev_raw_down", 0)
+        ref_multiplier = ref.multiplier  # ضریب reference
+        ref_prev_up = ref_meta.prev_raw_up
+        ref_prev_down = ref_meta.prev_raw_down
         
         for _, e, meta_entry in with_lc:
-            ct_data = e.get("ct") or {}
-            cur_up = int(ct_data.get("up") or 0)
-            cur_down = int(ct_data.get("down") or 0)
-            prev_up = meta_entry.get("prev_raw_up", 0)
-            prev_down = meta_entry.get("prev_raw_down", 0)
+            cur_up = e.ct.up if e.ct else 0
+            cur_down = e.ct.down if e.ct else 0
+            prev_up = meta_entry.prev_raw_up
+            prev_down = meta_entry.prev_raw_down
             
             # محاسبه delta (تفاوت با چرخه قبل)
             delta_up = cur_up - prev_up
@@ -343,7 +977,7 @@ def sync_once(conn, apply=False, debug=False):
             if delta_down < 0: delta_down = 0
             
             # اعمال ضریب از remark inbound (مثلاً [x0.5] یا [x2])
-            mult = e.get("multiplier", 1.0)
+            mult = e.multiplier
             delta_up = int(delta_up * mult)
             delta_down = int(delta_down * mult)
             
@@ -355,14 +989,14 @@ def sync_once(conn, apply=False, debug=False):
         max_up_across = 0
         max_down_across = 0
         for _, e, _ in with_lc:
-            ct_data = e.get("ct") or {}
-            max_up_across = max(max_up_across, int(ct_data.get("up") or 0))
-            max_down_across = max(max_down_across, int(ct_data.get("down") or 0))
+            if e.ct:
+                max_up_across = max(max_up_across, e.ct.up)
+                max_down_across = max(max_down_across, e.ct.down)
         
         # روش ساده و صحیح:
         # target = max_current + extra_deltas (delta هایی که از ref نیستن)
-        ref_cur_up = int(ref_ct.get("up") or 0)
-        ref_cur_down = int(ref_ct.get("down") or 0)
+        ref_cur_up = ref_ct.up if ref_ct else 0
+        ref_cur_down = ref_ct.down if ref_ct else 0
         
         # delta ref هم باید ضریب بخوره تا تفریق سازگار باشه
         ref_raw_delta_up = ref_cur_up - ref_prev_up if ref_cur_up >= ref_prev_up else 0
@@ -385,54 +1019,54 @@ def sync_once(conn, apply=False, debug=False):
         # چک کردن reset flag
         # با منطق delta، ref_used < max_used_across عادیه (چون delta ها جمع شدن)
         # فقط وقتی reset واقعی شده: وقتی ref_used کمتر از قبلش شده
-        ref_used = int(ref_sig.get("used") or 0)
+        ref_used = ref_sig.used
         ref_prev_used = ref_prev_up + ref_prev_down
         actual_reset = ref_used < ref_prev_used  # مصرف کاهش پیدا کرده = reset
         
-        group_reset_flag = any(int(x[1]["sig"].get("reset") or 0)==1 for x in with_lc) \
-                           or int(ref_sig.get("reset") or 0)==1 \
+        group_reset_flag = any(x[1].sig.reset==1 for x in with_lc) \
+                           or ref_sig.reset==1 \
                            or actual_reset
 
         # Enable status مستقیم از reference سینک میشه
         # پنل X-UI خودش بعد حجم/انقضا خاموش میکنه، ما فقط سینک میکنیم
-        ref_enable = int(ref_sig.get("enable", 1))
+        ref_enable = ref_sig.enable
 
         for _, e, _ in with_lc:
             ch={}
-            ref_quota = ref_sig.get("quota")
-            cur_q = e["client"].get("totalGB", None)
+            ref_quota = ref_sig.quota
+            cur_q = e.client.get("totalGB", None)
             try: cur_q = int(cur_q) if cur_q is not None else None
             except: cur_q = None
             if ref_quota is not None:
                 if cur_q != int(ref_quota):
                     ch["quota"]= (cur_q, int(ref_quota))
 
-            if ref_sig.get("limitIp") is not None:
-                cur_lim = e["client"].get("limitIp", None)
+            if ref_sig.limitIp is not None:
+                cur_lim = e.client.get("limitIp", None)
                 try: cur_lim = int(cur_lim) if cur_lim is not None else None
                 except: cur_lim = None
-                if cur_lim != int(ref_sig["limitIp"]):
-                    ch["limitIp"]= (cur_lim, int(ref_sig["limitIp"]))
+                if cur_lim != ref_sig.limitIp:
+                    ch["limitIp"]= (cur_lim, ref_sig.limitIp)
 
-            cur_exp = int(e["sig"].get("expiry") or 0)
-            ref_exp = int(ref_sig.get("expiry") or 0)
+            cur_exp = e.sig.expiry
+            ref_exp = ref_sig.expiry
             if cur_exp != ref_exp:
                 ch["expiry"]=(cur_exp, ref_exp)
 
-            cur_com = e["sig"].get("comment") or ""
-            ref_com = ref_sig.get("comment") or ""
+            cur_com = e.sig.comment
+            ref_com = ref_sig.comment
             if cur_com != ref_com:
                 ch["comment"]=(cur_com, ref_com)
 
             # بررسی تغییرات up و down - استفاده از مقادیر delta-based
-            cur_up = int(e["sig"].get("up") or 0)
-            cur_down = int(e["sig"].get("down") or 0)
+            cur_up = e.sig.up
+            cur_down = e.sig.down
             
             # اگر reset flag فعال باشد، از مقادیر reference استفاده کن
             # در غیر این صورت از target_up/down_final استفاده کن
             if group_reset_flag:
-                target_up = int(ref_sig.get("up") or 0)
-                target_down = int(ref_sig.get("down") or 0)
+                target_up = ref_sig.up
+                target_down = ref_sig.down
                 if cur_up != target_up or cur_down != target_down:
                     ch["up_down"] = ((cur_up, cur_down), (target_up, target_down))
             else:
@@ -443,9 +1077,9 @@ def sync_once(conn, apply=False, debug=False):
                     ch["up_down"] = ((cur_up, cur_down), (target_up, target_down))
 
 
-            cur_used = int(e["sig"].get("used") or 0)
+            cur_used = e.sig.used
             if group_reset_flag:
-                target_used = int(ref_sig.get("used") or 0)
+                target_used = ref_sig.used
             else:
                 target_used = max_used_across
 
@@ -453,7 +1087,7 @@ def sync_once(conn, apply=False, debug=False):
                 ch["used"]=(cur_used, target_used)
 
             if ref_quota is not None:
-                cur_quota_db = int(e["sig"].get("quota_db") or 0)
+                cur_quota_db = e.sig.quota_db
                 q_target = int(ref_quota)
                 if q_target > 0 and target_used > q_target:
                     q_target = target_used
@@ -461,13 +1095,13 @@ def sync_once(conn, apply=False, debug=False):
                     ch["quota_db"]=(cur_quota_db, q_target)
 
             # Check enable status - مستقیم از ref
-            cur_enable = int(e["sig"].get("enable", 1))
+            cur_enable = e.sig.enable
             target_enable = ref_enable
             if cur_enable != target_enable:
                 ch["enable"] = (cur_enable, target_enable)
 
             # Check UUID sync
-            cur_uuid = e["client"].get("id") or ""
+            cur_uuid = e.client.get("id") or ""
             ref_uuid = ref_client.get("id") or ""
             if ref_uuid and cur_uuid != ref_uuid:
                 ch["uuid"] = (cur_uuid, ref_uuid)
@@ -478,217 +1112,1089 @@ def sync_once(conn, apply=False, debug=False):
                     target_up = target_up_final if "up_down" in ch else cur_up
                     target_down = target_down_final if "up_down" in ch else cur_down
                 else:
-                    target_up = int(ref_sig.get("up") or 0)
-                    target_down = int(ref_sig.get("down") or 0)
+                    target_up = ref_sig.up
+                    target_down = ref_sig.down
                     
-                plans.append({"sub":sub, "iid":e["iid"], "email":e["email"], "cid":e["cid"], 
-                            "changes":ch, "ref_sig":ref_sig, "ref_client":ref_client,
-                            "reset_flag": group_reset_flag, "ref_updated": ref_updated,
-                            "target_up": target_up, "target_down": target_down})
+                plans.append(Plan(sub, e.iid, e.email, e.cid, ch, ref_sig, ref_client,
+                                  group_reset_flag, ref_updated, target_up, target_down, e.ct, e.panel, e.client))
+    return plans
+
+# --- sharded planning: گروه‌ها مستقل‌اند، هر shard توی یک process جدا plan میشه ---
+SHARD_MIN = 20000   # entries below which planning stays in this process
+SHARD_TIMEOUT = 120 # seconds a shard child gets before it is killed and planned here
+
+def plan_shard(part):
+    """plan_groups() on one shard, as compact records: (member, reference,
+    changes, reset_flag, ref_updated, target_up, target_down) with members
+    numbered in shard order."""
+    # Plan.client / ref_sig همون آبجکت‌های Entry هستن؛ شماره‌ی عضو از id اونا
+    idx={}; ref_idx={}
+    for _, items in part:
+        for e in items:
+            ref_idx[id(e.sig)]=idx[id(e.client)]=len(idx)
+    return [(idx[id(p.client)], ref_idx[id(p.ref_sig)], p.changes, p.reset_flag,
+             p.ref_updated, p.target_up, p.target_down) for p in plan_groups(dict(part))]
+
+def read_shard(r, deadline):
+    """All a shard child writes to the pipe r, or None when it is not done
+    by deadline (time.monotonic())"""
+    buf=[]
+    with os.fdopen(r, "rb", buffering=0) as f:
+        while True:
+            left=deadline-time.monotonic()
+            if left<=0 or not select.select([f], [], [], left)[0]: return None
+            b=f.read(1<<20)
+            if not b: return b"".join(buf)
+            buf.append(b)
+
+def plan_sharded(groups, shards):
+    """plan_groups() with the groups hash-partitioned by subId into `shards`
+    parts, each planned in a forked child process.
+
+    The children inherit the entries copy-on-write (with GC off, so the
+    heap isn't touched), and only the compact marshal records of
+    plan_shard() come back over a pipe. The Plans are rebuilt here around
+    the caller's own Entry objects, so they are the same as plan_groups()
+    gives. A shard whose child fails, or is not done within SHARD_TIMEOUT
+    (then it is killed), is planned here instead.
+
+    fork() copies only the calling thread, so a lock held by another
+    thread stays held in the child: main() refuses --plan-workers together
+    with the modes that run threads (--panel, --pipeline, --metrics-port).
+    """
+    n=sum(map(len, groups.values()))
+    if shards<2 or n<SHARD_MIN or not hasattr(os, "fork"):
+        return plan_groups(groups)
+    parts=[[] for _ in range(shards)]
+    for sub, items in groups.items():
+        parts[zlib.crc32(str(sub).encode())%shards].append((sub, items))
+    kids=[]
+    sys.stdout.flush()
+    deadline=time.monotonic()+SHARD_TIMEOUT
+    for part in parts:
+        if not part: continue
+        r, w = os.pipe()
+        pid=os.fork()
+        if pid==0:
+            code=1
+            try:
+                os.close(r); gc.disable()
+                with os.fdopen(w, "wb") as f: f.write(marshal.dumps(plan_shard(part)))
+                code=0
+            finally:
+                os._exit(code)
+        os.close(w)
+        kids.append((pid, r, part))
+    plans=[]
+    # صدها هزار tuple کوچیک: GC وسطش کل heap رو بی‌خود پیمایش می‌کنه
+    gc_on=gc.isenabled(); gc.disable()
+    try:
+        for pid, r, part in kids:
+            blob=read_shard(r, deadline)
+            if blob is None:
+                try: os.kill(pid, signal.SIGKILL)
+                except ProcessLookupError: pass
+            _, status = os.waitpid(pid, 0)
+            members=[e for _, items in part for e in items]
+            try:
+                if blob is None: raise ValueError(f"no result in {SHARD_TIMEOUT}s, killed")
+                if status: raise ValueError(f"exit status {status}")
+                recs=marshal.loads(blob)
+            except (ValueError, EOFError, TypeError) as e:
+                print(f"[WARN] planner shard failed ({e}), planning it here")
+                plans.extend(plan_groups(dict(part)))
+                continue
+            for i, ref, ch, reset_flag, ref_updated, target_up, target_down in recs:
+                e=members[i]; ref=members[ref]
+                plans.append(Plan(e.sub, e.iid, e.email, e.cid, ch, ref.sig, ref.client, reset_flag,
+                                  ref_updated, target_up, target_down, e.ct, e.panel, e.client))
+    finally:
+        if gc_on: gc.enable()
+    return plans
+
+def sync_once(conn, apply=False, debug=False, state=None, snapshot=None, planner=None):
+    """One client sync cycle.
+
+    snapshot is set by run_engines(): the caller already did the change
+    check and read the inbounds rows. Nothing is written here then: the meta
+    upserts go to snapshot["writes"] and the plans to snapshot["client"],
+    and run_engines() writes them with the other engines' writes. The
+    schema is migrated once at startup (ensure_meta).
+
+    planner: used instead of plan_groups(), e.g. plan_sharded() over
+    --plan-workers processes.
+    """
+    m = new_metrics(state)
+    commit = snapshot is None
+    if commit:
+        # PRAGMA data_version فقط با commit کانکشن‌های دیگه تغییر می‌کنه
+        if not db_changed(conn, state):
+            if debug: print("[IDLE] database unchanged, cycle skipped")
+            m["skipped"]=1
+            return 0
+        if state is not None: state["dirty"] = True
+    entries, dirty_subs, plan_all, changed = collect_entries(conn, m, debug, state, snapshot, defer=snapshot["writes"] if snapshot else None)
+    t=time.perf_counter()
+    if state is not None:
+        dirty_subs |= state.get("replan", set())
+    groups={}
+    for e in entries:
+        if plan_all or e.sub in dirty_subs:
+            groups.setdefault(e.sub, []).append(e)
+    if debug: print(f"[INFO] planning {len(groups)} subscription group(s)")
 
+    plans=(planner or plan_groups)(groups)
+    m["groups_planned"]=len(groups); m["plans"]=len(plans)
+    if state is not None:
+        # گروه‌هایی که الان plan دارن، چرخه بعد هم دوباره بررسی میشن
+        state["replan"] = {p.sub for p in plans}
+        track_deadlines(groups, plans, state, prune=True)
+    t=lap(m, "plan", t)
     if not plans:
+        if state is not None: state["dirty"] = changed
         print("[INFO] No changes required (all subscriptions already in sync).")
         return 0
 
     # --- APPLY ---
-    conn.execute("BEGIN")
-    cur=conn.cursor()
-    settings_cache={}
-    def get_settings(iid):
-        if iid in settings_cache: return settings_cache[iid]
-        cur.execute("SELECT settings FROM inbounds WHERE id=?", (iid,))
-        r=cur.fetchone()
-        s=jload(r[0] if r else "{}")
-        settings_cache[iid]=s
-        return s
-    def put_settings(iid, s):
-        settings_cache[iid]=s
-        cur.execute("UPDATE inbounds SET settings=? WHERE id=?", (jdump(s), iid))
+    # چند تراکنش کوتاه، هر کدوم چند گروه کامل (apply_chunked)؛ با snapshot
+    # همراه نوشتن‌های بقیه engineها در run_engines
+    if not commit:
+        snapshot["client"] = (plans, groups, m, state)
+        return len(plans)
+    set_writes, ct_writes = apply_guarded(conn, plans, groups, m, state, debug)
+    print(f"[APPLIED] settings_updated={set_writes}, traffic_rows_written={ct_writes}")
 
-    ct_writes=0; set_writes=0
+    return len(plans)
+
+# --- fast path: گروه‌های نزدیک به حجم/انقضا بین چرخه‌های کامل ---
+HOT_WINDOW = 120   # groups that may hit their quota or expiry within this many seconds are "hot"
+HOT_MAX = 200      # hot groups reconciled per fast-path tick
+
+def track_deadlines(groups, plans, state, prune=False):
+    """Estimate when each group in groups (subId -> [Entry]) hits its quota
+    or expiryTime and keep the hot ones in state["hot"], a heap of
+    (deadline, subId) with the most urgent group first.
+
+    The quota deadline comes from the group's merged usage and its growth
+    rate since the usage last changed (state["usage"]: subId -> (used, t)).
+    Groups whose members are all disabled already have nothing to enforce.
+    prune: drop subIds that no longer exist (full cycles only).
+    """
+    now=time.time()
+    usage=state.setdefault("usage", {})
+    hot={sub: d for d, sub in state.get("hot", ())}
+    targets={}
     for p in plans:
-        iid=p["iid"]; email=p["email"]; ch=p["changes"]; ref=p["ref_sig"]; reset_flag=p.get("reset_flag", False)
-
-        if any(k in ch for k in ("quota","limitIp","expiry","comment","uuid")):
-            s=get_settings(iid)
-            changed=False
-            for c in s.get("clients", []):
-                if (c.get("email") or "")==email and (c.get("subId") or c.get("subscription"))==p["sub"]:
-                    if "quota" in ch and "totalGB" in c:
-                        c["totalGB"]=int(ch["quota"][1])
-                        changed=True
-                    if "limitIp" in ch:
-                        c["limitIp"]=int(ch["limitIp"][1])
-                        changed=True
-                    if "expiry" in ch:
-                        c["expiryTime"]=int(ch["expiry"][1])
-                        changed=True
-                    if "comment" in ch:
-                        c["comment"]=ch["comment"][1]
-                        changed=True
-                    if "uuid" in ch:
-                        c["id"]=ch["uuid"][1]
-                        changed=True
-                    if changed:
-                        c["updated_at"] = int(p.get("ref_updated") or int(time.time() * 1000))
-                    break
-            if changed:
-                # ensure updated_at is set to reference timestamp for this client
-                try:
-                    for cc in s.get("clients", []):
-                        if (cc.get("subId") or cc.get("subscription"))==p["sub"] and ((cc.get("email") or "")==p["email"]):
-                            cc["updated_at"] = int(p.get("ref_updated") or int(time.time() * 1000))
-                            break
-                except Exception:
-                    pass
-                put_settings(iid, s)
-                set_writes+=1
+        targets[p.sub]=max(targets.get(p.sub, 0), p.target_up+p.target_down)
+    for sub, items in groups.items():
+        ref=max(items, key=lambda e: e.meta.lc).sig
+        used=max(targets.get(sub, 0), max(e.sig.used for e in items))
+        prev=usage.get(sub)
+        if prev is None or prev[0]!=used: usage[sub]=(used, now)
+        deadline=float("inf")
+        if ref.expiry>0:  # منفی = «بعد از اولین اتصال»، هنوز شروع نشده
+            deadline=ref.expiry/1000
+        if ref.quota:
+            left=ref.quota-used
+            if left<=0: deadline=now
+            elif prev and used>prev[0] and now>prev[1]:
+                deadline=min(deadline, now+left*(now-prev[1])/(used-prev[0]))
+        if deadline-now<=HOT_WINDOW and any(e.sig.enable for e in items): hot[sub]=deadline
+        else: hot.pop(sub, None)
+    if prune:
+        live=set(state.get("keys", {}).values())
+        for sub in [s for s in usage if s not in live]: del usage[sub]
+        for sub in [s for s in hot if s not in live]: del hot[sub]
+    heap=[(d, sub) for sub, d in hot.items()]
+    heapq.heapify(heap)
+    state["hot"]=heap
 
-        need_ct = any(k in ch for k in ("used","expiry","quota_db","enable","up_down"))
-        if need_ct:
-            cur.execute("SELECT id,up,down,total,expiry_time,enable,reset FROM client_traffics WHERE inbound_id=? AND email=?",
-                        (iid, email))
-            row=cur.fetchone()
-            rid=None; up0=0; down0=0; tot0=0; exp0=0; en0=1; reset0=0
-            if row:
-                rid, up0, down0, tot0, exp0, en0, reset0 = row
-                up0=int(up0 or 0); down0=int(down0 or 0); tot0=int(tot0 or 0); exp0=int(exp0 or 0)
-                en0=int(0 if en0 in (0,"0",False) else 1); reset0=int(reset0 or 0)
+def reload_groups(conn, subs, iids, m, cache=None, base=None):
+    """Fresh groups (subId -> [Entry]) for subs, read from just the inbounds
+    iids (re-scanning the ones whose settings changed), their traffic and
+    meta rows; signature changes are recorded like in a full cycle.
 
-            # استفاده از target_up و target_down
-            if "up_down" in ch:
-                new_up = p.get("target_up", up0)
-                new_down = p.get("target_down", down0)
-            else:
-                new_up = up0
-                new_down = down0
+    base: key -> MetaRow the current cycle planned with. Its meta upserts
+    already moved raw_up/raw_down in the table to this cycle's values, so
+    a group re-planned within the cycle takes its deltas from base instead.
+    Returns (groups, meta upserts written)."""
+    t=time.perf_counter()
+    inbs=load_inbounds(conn, cache=cache, ids=iids)
+    members=[(iid, multiplier, sub, email, cid, cl) for iid, _r, _rm, multiplier, clients in inbs
+             for sub, email, cid, cl in clients if sub in subs]
+    if not members: return {}, []
+    pairs=sorted({(iid, email) for iid, _, _, email, _, _ in members})
+    ct={}
+    for part in chunks(pairs):
+        for rid, iid, email, up, down, total, expiry, enable, reset in conn.execute(
+                "SELECT id,inbound_id,email,up,down,total,expiry_time,enable,reset FROM client_traffics "
+                f"WHERE (inbound_id, email) IN (VALUES {','.join(['(?,?)']*len(part))})", [v for pr in part for v in pr]):
+            ct.setdefault((int(iid), email or ""), CtRow(int(rid), int(iid), email or "", int(up or 0), int(down or 0),
+                          int(total or 0), int(expiry or 0), int(0 if enable in (0,"0",False) else 1), int(reset or 0)))
+    keys=[key_for(sub, iid, email, cid) for iid, _, sub, email, cid, _ in members]
+    meta={}
+    for part in chunks(sorted(set(keys))):
+        for k, sig_hash, lc, raw_up, raw_down in conn.execute(
+                f"SELECT key,sig_hash,last_change,raw_up,raw_down FROM sync_meta_client WHERE key IN ({','.join('?'*len(part))})", part):
+            meta[k]=MetaRow(sig_hash, int(lc or 0), int(raw_up or 0), int(raw_down or 0))
+    m["rows_read"]+=len(inbs)+len(ct)+len(meta)
+    if base:
+        for k in keys:
+            b=base.get(k)
+            if b is not None: meta[k]=MetaRow(b.sig_hash, b.lc, b.prev_raw_up, b.prev_raw_down)
+    t=lap(m, "load", t)
 
-            new_quota_db = tot0
-            if "quota_db" in ch:
-                new_quota_db = int(ch["quota_db"][1])
-            
-            # اطمینان از اینکه quota_db از مجموع up+down کمتر نباشد
-            total_used = new_up + new_down
-            if new_quota_db > 0 and new_quota_db < total_used:
-                new_quota_db = total_used
+    now=int(time.time())
+    upserts=[]; groups={}
+    for (iid, multiplier, sub, email, cid, cl), k in zip(members, keys):
+        ct_row=ct.get((iid, email))
+        sig=signature(cl, ct_row)
+        sig_hash=sig_digest(sig)
+        old=meta.get(k)
+        if old is None or old.sig_hash!=sig_hash:
+            upserts.append((k, sub, iid, email, cid, sig_hash, now, ct_row.up if ct_row else 0, ct_row.down if ct_row else 0))
+            if old: old.sig_hash=sig_hash; old.lc=now
+            else: old=meta[k]=MetaRow(sig_hash, now, 0, 0)
+        groups.setdefault(sub, []).append(Entry(sub, iid, email, cid, cl, ct_row, sig, k, multiplier, old))
+    if upserts:
+        conn.executemany("INSERT OR REPLACE INTO sync_meta_client(key,subId,inbound_id,email,client_id,sig_hash,last_change,raw_up,raw_down) VALUES(?,?,?,?,?,?,?,?,?)", upserts)
+        conn.commit()
+    lap(m, "meta", t)
+    return groups, upserts
 
-            new_expiry = exp0
-            if "expiry" in ch:
-                new_expiry = int(ch["expiry"][1])
+def sync_hot(conn, debug=False, state=None, limit=HOT_MAX):
+    """Fast path between full cycles: reconcile only the `limit` most urgent
+    groups of state["hot"].
 
-            new_enable = en0
-            if "enable" in ch:
-                new_enable = int(ch["enable"][1])
+    Reads just their inbounds (re-scanning the ones whose settings changed),
+    traffic rows and meta rows, records signature changes like a full cycle
+    and applies the plans. Membership comes from the last full cycle, so a
+    client added since then is only picked up by the next one.
+    """
+    if state is None or not state.get("hot"): return 0
+    subs={sub for _, sub in heapq.nsmallest(limit, state["hot"])}
+    m={"phases":{}, "rows_read":0, "groups_planned":0, "plans":0, "lock_wait":0.0, "skipped":0}
+    state["hot_metrics"]=m
+    iids={e.iid for e in state.get("entries", ()) if e.sub in subs}
+    groups, upserts = reload_groups(conn, subs, iids, m, state.get("inbounds"))
+    if not groups: return 0
+    t=time.perf_counter()
+    plans=plan_groups(groups)
+    m["groups_planned"]=len(groups); m["plans"]=len(plans)
+    track_deadlines(groups, plans, state)
+    t=lap(m, "plan", t)
+    if upserts or plans:
+        state["dirty"]=True  # چرخه کامل بعدی رد نشه
+    if not plans: return 0
+    set_writes, ct_writes = apply_guarded(conn, plans, groups, m, state, debug)
+    if debug: print(f"[HOT] {len(groups)} group(s): settings_updated={set_writes}, traffic_rows_written={ct_writes}")
+    return len(plans)
 
-            if rid:
-                cur.execute("UPDATE client_traffics SET up=?,down=?,total=?,expiry_time=?,enable=?,reset=0 WHERE id=?",
-                            (new_up, new_down, new_quota_db, new_expiry, new_enable, rid))
-            else:
-                cur.execute("INSERT INTO client_traffics(inbound_id,enable,email,up,down,expiry_time,total,reset) VALUES(?,?,?,?,?,?,?,0)",
-                            (iid, new_enable, email, new_up, new_down, new_expiry, new_quota_db))
+# --- SQL engine: گروه‌بندی و تشخیص تغییر داخل SQLite (JSON1) ---
+WS = "' ' || char(9, 10, 11, 12, 13)"  # مثل str.strip() برای ASCII
+# هر کلاینت هر inbound یک ردیف؛ parse تنظیمات با json_each داخل C انجام میشه
+SQL_CLIENTS = """
+SELECT i.id AS iid, c.key AS pos, i.remark AS remark,
+       COALESCE(NULLIF(json_extract(c.value, '$.subId'), ''), NULLIF(json_extract(c.value, '$.subscription'), '')) AS sub,
+       COALESCE(NULLIF(json_extract(c.value, '$.email'), ''), '') AS email,
+       COALESCE(NULLIF(json_extract(c.value, '$.id'), ''), '') AS cid,
+       json_extract(c.value, '$.totalGB') AS quota, json_extract(c.value, '$.expiryTime') AS expiry,
+       json_extract(c.value, '$.limitIp') AS limit_ip, json_extract(c.value, '$.comment') AS comment,
+       json_extract(c.value, '$.updated_at') AS updated_at
+FROM inbounds i
+JOIN json_each(CASE WHEN json_valid(i.settings) THEN
+                 CASE WHEN json_type(i.settings, '$.clients') = 'array' THEN i.settings END END, '$.clients') c
+WHERE c.type = 'object'
+"""
+# کلید مثل key_for؛ اگه جایی نخونه، اون گروه فقط هر بار بررسی میشه
+SQL_KEY = f"sub || '|' || iid || '|' || CASE WHEN trim(cid, {WS}) <> '' THEN trim(cid, {WS}) ELSE trim(email, {WS}) END"
+# ورودی‌های signature(): تا وقتی عوض نشدن، signature هم عوض نشده
+SQL_FP = ("quote(quota) || '|' || quote(expiry) || '|' || quote(comment) || '|' || quote(limit_ip) || '|' || "
+          "quote(updated_at) || '|' || quote(ct_id) || '|' || quote(up) || '|' || quote(down) || '|' || "
+          "quote(total) || '|' || quote(enable) || '|' || quote(reset)")
 
-            ct_writes+=1
+def json1_available(conn):
+    try: return conn.execute("SELECT json_valid('{}')").fetchone()[0] == 1
+    except sqlite3.OperationalError: return False
 
-            # After writing traffic row, ensure inbound settings client.updated_at matches reference timestamp
-            try:
-                s = get_settings(iid)
-                changed2 = False
-                for cc in s.get("clients", []):
-                    if (cc.get("subId") or cc.get("subscription"))==p["sub"] and ((cc.get("email") or "")==p["email"]):
-                        if int(cc.get("updated_at") or 0) != int(p.get("ref_updated") or 0):
-                            cc["updated_at"] = int(p.get("ref_updated") or int(time.time() * 1000))
-                            changed2 = True
-                            break
-                if changed2:
-                    put_settings(iid, s)
-                    set_writes += 1
-            except Exception:
-                pass
-
-    # --- RECOMPUTE and store actual signature for each changed client ---
-    now=int(time.time())
-    for p in plans:
-        iid = p["iid"]; sub = p["sub"]; email = p["email"]; cid = p["cid"]
-        cur.execute("SELECT settings FROM inbounds WHERE id=?", (iid,))
-        r = cur.fetchone()
-        s = jload(r[0] if r else "{}")
-        client_obj = {}
-        for c in s.get("clients", []):
-            if (c.get("subId") or c.get("subscription")) == sub and ((c.get("email") or "") == email or (not c.get("email") and email=="")):
-                client_obj = c
-                break
-        if not client_obj:
-            ref_sig = p["ref_sig"]
-            client_obj = {
-                "totalGB": ref_sig.get("quota"),
-                "expiryTime": ref_sig.get("expiry"),
-                "comment": ref_sig.get("comment"),
-                "limitIp": ref_sig.get("limitIp")
-            }
-        cur.execute("SELECT up,down,total,expiry_time,enable,reset FROM client_traffics WHERE inbound_id=? AND email=?", (iid, email))
-        row = cur.fetchone()
-        ct_row = {}
-        if row:
-            up,down,total,expiry_time,enable,reset = row
-            ct_row = {
-                "up": int(up or 0),
-                "down": int(down or 0),
-                "quota_db": int(total or 0),
-                "expiry": int(expiry_time or 0),
-                "enable": int(0 if enable in (0,"0",False) else 1),
-                "reset": int(reset or 0)
-            }
-        else:
-            ct_row = {"up":0,"down":0,"quota_db":0,"expiry":0,"enable":1,"reset":0}
+def refresh_members(conn):
+    """Bring the connection's temp.sync_clients (every client of every
+    inbound, key NULL without subId) up to date; only inbounds whose
+    settings or remark changed since the last call are re-scanned.
+    temp.sync_members adds the client_traffics row and fp. Returns the
+    number of re-scanned inbounds. Nothing here takes the main database's
+    write lock."""
+    for ddl in ("CREATE TEMP TABLE IF NOT EXISTS sync_seen(id INTEGER PRIMARY KEY, settings, remark)",
+                "CREATE TEMP TABLE IF NOT EXISTS sync_scan(id INTEGER PRIMARY KEY)",
+                "CREATE TEMP TABLE IF NOT EXISTS sync_clients(iid, pos, remark, sub, email, cid, quota, expiry, limit_ip, comment, updated_at, key)",
+                "CREATE INDEX IF NOT EXISTS temp.sync_clients_iid ON sync_clients(iid, pos)",
+                "CREATE INDEX IF NOT EXISTS temp.sync_clients_sub ON sync_clients(sub)",
+                "CREATE INDEX IF NOT EXISTS temp.sync_clients_key ON sync_clients(key)",
+                f"""CREATE TEMP VIEW IF NOT EXISTS sync_members AS
+                    SELECT *, {SQL_FP} AS fp FROM (
+                      SELECT c.*, t.id AS ct_id, t.up AS up, t.down AS down, t.total AS total, t.expiry_time AS ct_expiry,
+                             t.enable AS enable, t.reset AS reset
+                      FROM temp.sync_clients c LEFT JOIN client_traffics t ON t.inbound_id = c.iid AND t.email = c.email)"""):
+        conn.execute(ddl)
+    conn.execute("DELETE FROM temp.sync_scan")
+    conn.execute("""INSERT INTO temp.sync_scan
+        SELECT i.id FROM inbounds i LEFT JOIN temp.sync_seen s ON s.id = i.id
+        WHERE s.id IS NULL OR s.settings IS NOT i.settings OR s.remark IS NOT i.remark
+        UNION SELECT id FROM temp.sync_seen WHERE id NOT IN (SELECT id FROM inbounds)""")
+    n = conn.execute("SELECT count(*) FROM temp.sync_scan").fetchone()[0]
+    if n:
+        conn.execute("DELETE FROM temp.sync_clients WHERE iid IN (SELECT id FROM temp.sync_scan)")
+        conn.execute("DELETE FROM temp.sync_seen WHERE id IN (SELECT id FROM temp.sync_scan)")
+        conn.execute("INSERT INTO temp.sync_seen SELECT id, settings, remark FROM inbounds WHERE id IN (SELECT id FROM temp.sync_scan)")
+        conn.execute(f"""INSERT INTO temp.sync_clients SELECT *, CASE WHEN sub IS NOT NULL THEN {SQL_KEY} END FROM ({SQL_CLIENTS}
+            AND i.id IN (SELECT id FROM temp.sync_scan))""")
+    return n
 
-        new_sig = signature(client_obj, ct_row)
-        k = key_for(sub, iid, email, cid)
-        # ذخیره signature جدید به همراه مقادیر raw جدید (بعد از سینک)
-        new_raw_up = int(ct_row.get("up") or 0)
-        new_raw_down = int(ct_row.get("down") or 0)
-        cur.execute("UPDATE sync_meta_client SET signature=?, last_change=?, raw_up=?, raw_down=? WHERE key=?", 
-                    (jdump(new_sig), now, new_raw_up, new_raw_down, k))
+def sync_once_sql(conn, apply=False, debug=False, state=None, planner=None):
+    """One client cycle with membership, the traffic join and change
+    detection done in SQLite.
+
+    sync_meta_client.sql_fp holds the signature inputs of every entry as of
+    the last time its group was planned. Only groups with a member whose
+    inputs differ (or that is new, or was removed, or whose group had plans
+    last cycle) come back to Python, where they go through the same
+    signature bookkeeping and plan_groups() as in sync_once, so the results
+    are the same. Clients sharing a UUID without a common subId go through
+    link_sub_by_uuid() first.
 
+    The equivalence is gated by `bench_sync.py --verify-sql`, which exits
+    non-zero on the first cycle where this and sync_once() differ.
+    """
+    m = new_metrics(state)
+    if not db_changed(conn, state):
+        if debug: print("[IDLE] database unchanged, cycle skipped")
+        m["skipped"]=1
+        return 0
+    if state is not None: state["dirty"] = True
+    t=time.perf_counter()
+    refresh_members(conn)
+    t=lap(m, "load", t)
+    # مسیر پایتونی لینک فقط وقتی UUID مشترک با subId ناهمسان هست
+    linkable = conn.execute(f"""
+        SELECT 1 FROM temp.sync_clients WHERE trim(cid, {WS}) <> ''
+        GROUP BY trim(cid, {WS})
+        HAVING count(*) > 1 AND max(trim(COALESCE(sub, ''), {WS})) <> '' AND count(DISTINCT trim(COALESCE(sub, ''), {WS})) > 1
+        LIMIT 1""").fetchone()
+    linked = 0
+    if linkable:
+        linked = link_sub_by_uuid(conn, debug=debug)
+        if linked: refresh_members(conn)
+    t=lap(m, "link", t)
+
+    conn.execute("CREATE TEMP TABLE IF NOT EXISTS sync_flagged(sub PRIMARY KEY) WITHOUT ROWID")
+    conn.execute("DELETE FROM temp.sync_flagged")
+    conn.execute("""INSERT OR IGNORE INTO temp.sync_flagged
+        SELECT k.sub FROM temp.sync_members k LEFT JOIN sync_meta_client s ON s.key = k.key
+        WHERE k.sub IS NOT NULL AND (s.key IS NULL OR s.sql_fp IS NOT k.fp)""")
+    # کلیدهایی که دیگه وجود ندارن گروهشون رو یک بار dirty می‌کنن
+    gone = conn.execute("""SELECT key, subId FROM sync_meta_client s
+        WHERE s.sql_fp IS NOT NULL AND NOT EXISTS (SELECT 1 FROM temp.sync_clients k WHERE k.key = s.key)""").fetchall()
+    replan = state.get("replan", ()) if state is not None else ()
+    conn.executemany("INSERT OR IGNORE INTO temp.sync_flagged VALUES(?)", [(sub,) for _, sub in gone] + [(sub,) for sub in replan])
+    rows = conn.execute("""
+        SELECT k.iid, k.remark, k.sub, k.email, k.cid, k.quota, k.expiry, k.limit_ip, k.comment, k.updated_at,
+               k.ct_id, k.up, k.down, k.total, k.ct_expiry, k.enable, k.reset,
+               k.fp, s.key, s.sig_hash, s.last_change, s.raw_up, s.raw_down, s.sql_fp
+        FROM temp.sync_members k LEFT JOIN sync_meta_client s ON s.key = k.key
+        WHERE k.sub IN (SELECT sub FROM temp.sync_flagged)
+        ORDER BY k.iid, k.pos""").fetchall()
     conn.commit()
+    m["rows_read"]+=len(rows)
+    t=lap(m, "load", t)
+
+    now=int(time.time())
+    upserts=[]; fps=[]; groups={}; meta={}; mults={}
+    for (iid, remark, sub, email, cid, quota, expiry, limit_ip, comment, updated_at,
+         ct_id, up, down, total, ct_expiry, enable, reset, fp, mkey, sig_hash, lc, raw_up, raw_down, sql_fp) in rows:
+        cl = {"subId": sub, "email": email, "id": cid, "totalGB": quota, "expiryTime": expiry,
+              "limitIp": limit_ip, "comment": comment, "updated_at": updated_at}
+        ct_row = CtRow(int(ct_id), iid, email, int(up or 0), int(down or 0), int(total or 0), int(ct_expiry or 0),
+                       int(0 if enable in (0,"0",False) else 1), int(reset or 0)) if ct_id is not None else None
+        k = key_for(sub, iid, email, cid)
+        if k not in meta:
+            if mkey == k:
+                meta[k] = MetaRow(sig_hash, int(lc or 0), int(raw_up or 0), int(raw_down or 0))
+            else:
+                # کلید SQL با key_for نخوند؛ ردیف meta مستقیم خونده میشه
+                r = conn.execute("SELECT sig_hash,last_change,raw_up,raw_down FROM sync_meta_client WHERE key=?", (k,)).fetchone()
+                meta[k] = MetaRow(r[0], int(r[1] or 0), int(r[2] or 0), int(r[3] or 0)) if r else None
+        old = meta[k]
+        sig = signature(cl, ct_row)
+        h = sig_digest(sig)
+        if old is None or old.sig_hash != h:
+            upserts.append((k, sub, iid, email, cid, h, now, ct_row.up if ct_row else 0, ct_row.down if ct_row else 0, fp))
+            if old: old.sig_hash = h; old.lc = now
+            else: old = meta[k] = MetaRow(h, now, 0, 0)
+            if debug: print("[META] change", k, "->", dict(sig.items()))
+        elif mkey == k and sql_fp != fp:
+            fps.append((fp, k))
+        mult = mults.get(remark)
+        if mult is None: mult = mults[remark] = parse_multiplier(remark)
+        groups.setdefault(sub, []).append(Entry(sub, iid, email, cid, cl, ct_row, sig, k, mult, old))
+    # sql_fp ورودی‌های قبل از apply رو نگه می‌داره؛ ردیف‌هایی که نوشتیم چرخه بعد دوباره بررسی میشن
+    if upserts or fps or gone:
+        conn.executemany("INSERT OR REPLACE INTO sync_meta_client(key,subId,inbound_id,email,client_id,sig_hash,last_change,raw_up,raw_down,sql_fp) VALUES(?,?,?,?,?,?,?,?,?,?)", upserts)
+        conn.executemany("UPDATE sync_meta_client SET sql_fp = ? WHERE key = ?", fps + [(None, k) for k, _ in gone])
+        conn.commit()
+        if debug and upserts: print(f"[INFO] meta updated {len(upserts)}")
+    t=lap(m, "meta", t)
+    if debug: print(f"[INFO] planning {len(groups)} subscription group(s)")
+    plans = (planner or plan_groups)(groups)
+    m["groups_planned"]=len(groups); m["plans"]=len(plans)
+    if state is not None:
+        state["replan"] = {p.sub for p in plans}
+    t=lap(m, "plan", t)
+    set_writes = ct_writes = 0
+    if plans:
+        # اینجا رکورد فشرده‌ی کلاینت ساخته نشده؛ CAS با blob تنظیماتی که refresh_members خوند
+        # و ردیف‌های client_traffics همون read
+        blobs={}
+        for part in chunks(sorted({p.iid for p in plans})):
+            blobs.update(conn.execute(f"SELECT id, settings FROM temp.sync_seen WHERE id IN ({','.join('?'*len(part))})", part))
+        set_writes, ct_writes = apply_guarded(conn, plans, groups, m, state, debug, cas_ct=True, cas_blobs=blobs)
+    if state is not None: state["dirty"] = bool(linked or upserts or plans)
+    if not plans:
+        print("[INFO] No changes required (all subscriptions already in sync).")
+        return 0
     print(f"[APPLIED] settings_updated={set_writes}, traffic_rows_written={ct_writes}")
+    return len(plans)
+
+# --- pipelined loop: snapshot روی کانکشن read-only، نوشتن روی thread جدا ---
+def open_snapshot(db_path):
+    """Read-only connection for the pipelined loop's snapshots"""
+    ro=sqlite3.connect(f"file:{urllib.parse.quote(os.path.abspath(db_path))}?mode=ro", uri=True, timeout=60)
+    ro.execute("PRAGMA busy_timeout = 3000")
+    return ro
+
+def write_cycle(conn, defer, plans, m, state, groups=None):
+    """Writer side of a pipelined cycle, on the writer's own connection:
+    the deferred link / meta writes in one transaction, then the plans with
+    compare-and-swap against the snapshot. Returns the conflicting subIds,
+    whose traffic baseline is put back (restore_raw)."""
+    cas=set()
+    if defer:
+        tl=time.perf_counter()
+        conn.execute("BEGIN IMMEDIATE")
+        m["lock_wait"]+=time.perf_counter()-tl
+        try:
+            for fn in defer: fn(conn)
+            conn.commit()
+        except Exception:
+            conn.rollback(); raise
+    if plans:
+        set_writes, ct_writes = apply_chunked(conn, plans, m, state, cas=cas, cas_ct=True)
+        print(f"[APPLIED] settings_updated={set_writes}, traffic_rows_written={ct_writes}"
+              + (f", skipped {len(cas)} group(s) changed since the snapshot" if cas else ""))
+        if cas and groups: restore_raw(conn, groups, cas)
+    return cas
 
+def sync_pipelined(ro, conn, writer, apply=False, debug=False, state=None, planner=None):
+    """One client cycle of the pipelined loop.
+
+    The snapshot is read in one read transaction on ro (opened with
+    mode=ro), so it never waits on our own writes, and it may overlap the
+    previous cycle's writer. Planning is the same as in sync_once. The
+    writes go to `writer` (a single-thread executor owning conn); a group
+    that changed between its snapshot and the write is skipped and planned
+    again from the next snapshot.
+
+    When the snapshot was read before the previous writer finished, the
+    groups that writer wrote are read again on conn once it has committed
+    (reload_groups), so they are planned from the counters and meta it left.
+    """
+    m = new_metrics(state)
+    prev = state.pop("write", None)
+    if not db_changed(ro, state) and prev is None:
+        if debug: print("[IDLE] database unchanged, cycle skipped")
+        m["skipped"]=1
+        return 0
+    overlap = prev is not None and not prev.done()
+    t=time.perf_counter()
+    defer=[]
+    ro.execute("BEGIN")
+    try:
+        rows=ro.execute("SELECT id, settings, remark FROM inbounds").fetchall()
+        t=lap(m, "load", t)
+        entries, dirty_subs, plan_all, changed = collect_entries(ro, m, debug, state, {"inbounds": rows}, commit=False, defer=defer, pipelined=True)
+    finally:
+        ro.commit()
+    t=time.perf_counter()
+    # نتیجه‌ی writer چرخه قبل: گروه‌های conflict دار این دور دوباره plan میشن
+    cas = prev.result() if prev is not None else set()
+    t=lap(m, "writer_wait", t)
+    written = state.pop("written", set())
+    if overlap and written and entries:
+        # snapshot قبل از commit چرخه قبل خونده شده؛ گروه‌هایی که اون نوشت از نو
+        iids={e.iid for e in entries if e.sub in written}
+        fresh, _ = writer.submit(reload_groups, conn, written, iids, m).result()
+        entries=[e for e in entries if e.sub not in written]+[e for g in fresh.values() for e in g]
+        state["entries"]=entries
+        dirty_subs |= written
+        t=time.perf_counter()
+    dirty_subs |= state.get("replan", set()) | cas
+    groups={}
+    for e in entries:
+        if plan_all or e.sub in dirty_subs:
+            groups.setdefault(e.sub, []).append(e)
+    if debug: print(f"[INFO] planning {len(groups)} subscription group(s)")
+    plans=(planner or plan_groups)(groups)
+    m["groups_planned"]=len(groups); m["plans"]=len(plans)
+    state["replan"] = {p.sub for p in plans} | cas
+    # چرخه بعد حتی بدون commit تازه اجرا بشه تا گروه‌های conflict دوباره بررسی بشن
+    state["dirty"] = bool(cas)
+    lap(m, "plan", t)
+    if defer or plans:
+        state["write"] = writer.submit(write_cycle, conn, defer, plans, m, state, groups)
+        state["written"] = set(groups)
+    if not plans:
+        print("[INFO] No changes required (all subscriptions already in sync).")
     return len(plans)
 
+# --- multi-panel: یک subId روی چند x-ui.db ---
+PANEL_WORKERS = 8
+
+def sync_panels(conns, apply=False, debug=False, state=None, pool=None, planner=None):
+    """One client cycle over several x-ui databases (one connection each,
+    opened with check_same_thread=False).
+
+    Panels are loaded concurrently on pool; subscription groups are formed
+    across all of them, so the usage deltas of a subId are merged from every
+    panel the same way sync_once merges inbounds, and each panel gets the
+    plans of its own entries written back. A panel whose DB did not change
+    reuses the entries of its previous cycle, and a panel that fails is left
+    out of this cycle only (its deltas are picked up once it is back).
+
+    state: kept across cycles by the loop; state["panels"][i] is the
+    per-database state of conns[i].
+    """
+    m = new_metrics(state)
+    if state is not None:
+        panels = state.setdefault("panels", [])
+        panels.extend({} for _ in range(len(conns)-len(panels)))
+    else:
+        panels = [None]*len(conns)
+    own_pool = pool is None
+    if own_pool:
+        pool = ThreadPoolExecutor(max_workers=min(PANEL_WORKERS, len(conns)))
+    try:
+        def load(i):
+            conn, st = conns[i], panels[i]
+            pm = new_metrics(st)
+            try:
+                if not db_changed(conn, st):
+                    pm["skipped"] = 1
+                    return st.get("entries", []), set(), False, False, pm
+                if st is not None: st["dirty"] = True
+                return (*collect_entries(conn, pm, debug, st, panel=i), pm)
+            except Exception as e:
+                print(f"[ERROR] panel {i}: load: {e}")
+                if st is not None: st["dirty"] = True
+                return None
+
+        t = time.perf_counter()
+        loaded = list(pool.map(load, range(len(conns))))
+        t = lap(m, "load", t)
+        if all(r is not None and r[4]["skipped"] for r in loaded):
+            if debug: print("[IDLE] no panel changed, cycle skipped")
+            m["skipped"] = 1
+            return 0
+
+        entries = []; dirty_subs = set(); plan_all = False
+        for r in loaded:
+            if r is None: continue
+            entries.extend(r[0]); dirty_subs |= r[1]; plan_all = plan_all or r[2]
+            m["rows_read"] += r[4]["rows_read"]
+        plan_all = plan_all or state is None
+        if state is not None:
+            dirty_subs |= state.get("replan", set())
+        groups = {}
+        for e in entries:
+            if plan_all or e.sub in dirty_subs:
+                groups.setdefault(e.sub, []).append(e)
+        if debug: print(f"[INFO] planning {len(groups)} subscription group(s) over {len(conns)} panel(s)")
+        plans = (planner or plan_groups)(groups)
+        m["groups_planned"] = len(groups); m["plans"] = len(plans)
+        t = lap(m, "plan", t)
+        if state is not None:
+            state["replan"] = {p.sub for p in plans}
+
+        by_panel = {}
+        for p in plans: by_panel.setdefault(p.panel, []).append(p)
+        for i, r in enumerate(loaded):
+            if r is not None and panels[i] is not None:
+                panels[i]["dirty"] = r[3] or i in by_panel
+        if not plans:
+            print("[INFO] No changes required (all subscriptions already in sync).")
+            return 0
+
+        def write(i):
+            pm = loaded[i][4]
+            cas = set()
+            try:
+                # گروه‌هایی که وسط کار توی پنل عوض شدن رد میشن؛ همه‌ی گروه‌های plan دار چرخه بعد دوباره بررسی میشن
+                sw, cw = apply_chunked(conns[i], by_panel[i], pm, panels[i], cas=cas)
+                print(f"[APPLIED] panel={i} settings_updated={sw}, traffic_rows_written={cw}")
+            except Exception as e:
+                print(f"[ERROR] panel {i}: apply: {e}")
+            return pm["lock_wait"], cas
+
+        done = dict(zip(sorted(by_panel), pool.map(write, sorted(by_panel))))
+        m["lock_wait"] = sum(w for w, _ in done.values())
+        # گروهی که توی یک پنل نوشته شده، delta بقیه رو جذب کرده؛ فقط اگه همه‌جا رد شده baseline برمی‌گرده
+        written = {p.sub for i, (_, cas) in done.items() for p in by_panel[i] if p.sub not in cas}
+        skipped = set().union(*(cas for _, cas in done.values())) - written
+        if skipped:
+            for i in {e.panel for sub in skipped for e in groups.get(sub, ()) if not loaded[e.panel][4]["skipped"]}:
+                restore_raw(conns[i], groups, skipped, panel=i)
+        lap(m, "apply", t)
+        return len(plans)
+    finally:
+        if own_pool: pool.shutdown()
+
+ENGINES = ("client", "tunnel")
+
+def run_engines(conn, engines, apply=False, debug=False, states=None):
+    """One cycle of the selected engines ("client", "tunnel") on a single
+    read of inbounds, with all of their writes together.
+
+    The read ends with the inbounds rows; each engine then loads and plans
+    outside any transaction and hands its writes back in the snapshot. They
+    go through apply_guarded() like a standalone client cycle: the first
+    BEGIN IMMEDIATE chunk holds the tunnel's writes and the client's meta
+    upserts, and every chunk of client plans is compare-and-swapped against
+    the read it was planned from.
+
+    states: engine -> state dict kept across cycles by the loop.
+    """
+    mods = {"client": sys.modules[__name__]}
+    if "tunnel" in engines:
+        import sync_inbound_tunnel
+        mods["tunnel"] = sync_inbound_tunnel
+    run = []
+    for name in engines:
+        st = states.setdefault(name, {}) if states is not None else None
+        if mods[name].db_changed(conn, st):
+            if st is not None: st["dirty"] = True
+            run.append((name, st))
+        else:
+            mods[name].new_metrics(st)["skipped"] = 1
+    if not run:
+        if debug: print("[IDLE] database unchanged, cycle skipped")
+        return 0
+
+    # بدون تراکنش: قفل خواندن فقط تا آخر همین SELECT
+    settings_col = "settings" if any(name == "client" for name, _ in run) else "NULL"
+    rows = conn.execute(f"SELECT id, {settings_col}, remark, protocol, up, down, total, expiry_time FROM inbounds").fetchall()
+    snapshot = {"inbounds": rows, "writes": []}
+    n = 0
+    for name, st in run:
+        n += mods[name].sync_once(conn, apply=apply, debug=debug, state=st, snapshot=snapshot)
+    client = snapshot.get("client")
+    if client is None and not snapshot["writes"]:
+        return n
+    plans, groups, m, st = client or ([], {}, snapshot["m"], None)
+    try:
+        set_writes, ct_writes = apply_guarded(conn, plans, groups, m, st, debug, pre=snapshot["writes"])
+    except Exception:
+        # نوشتن‌های این چرخه از دست رفتن؛ چرخه بعد حتما اجرا میشه
+        for _, st in run:
+            if st is not None: st["dirty"] = True
+        raise
+    if client:
+        print(f"[APPLIED] settings_updated={set_writes}, traffic_rows_written={ct_writes}")
+    return n
+
+# --- GC: ردیف‌های meta که دیگه هیچ کلاینتی ندارن ---
+GC_INTERVAL = 3600  # seconds between GC runs of the loop
+GC_BATCH = 500      # rows deleted per write transaction
+GC_PAUSE = 0.01     # between batches, so x-ui gets the lock
+
+def delete_stale(conn, table, keys, before, batch=GC_BATCH, vacuum=0, debug=False):
+    """Delete the rows of `keys` from a meta table in short transactions of
+    `batch` rows. A row written at or after `before` (unix seconds) is kept:
+    its key came back after the scan that found it stale.
+
+    vacuum: with auto_vacuum=INCREMENTAL, give up to this many free pages
+    back to the file system afterwards. Returns the rows deleted.
+    """
+    page=conn.execute("PRAGMA page_size").fetchone()[0]
+    free0=conn.execute("PRAGMA freelist_count").fetchone()[0]
+    size0=conn.execute("PRAGMA page_count").fetchone()[0]
+    n=0
+    for part in chunks(keys, batch):
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            n+=conn.execute(f"DELETE FROM {table} WHERE COALESCE(last_change, 0) < ? AND key IN ({','.join('?'*len(part))})",
+                            (before, *part)).rowcount
+            conn.commit()
+        except Exception:
+            conn.rollback(); raise
+        time.sleep(GC_PAUSE)
+    freed=conn.execute("PRAGMA freelist_count").fetchone()[0]-free0
+    if vacuum>0:
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0]==2:
+            # execute() فقط یک step میره یعنی یک صفحه؛ executescript تا آخر
+            conn.executescript(f"PRAGMA incremental_vacuum({int(vacuum)});")
+        elif debug:
+            print("[GC] auto_vacuum is not INCREMENTAL, vacuum skipped "
+                  "(PRAGMA auto_vacuum=INCREMENTAL; VACUUM; while x-ui is stopped)")
+    shrunk=size0-conn.execute("PRAGMA page_count").fetchone()[0]
+    if n or debug:
+        print(f"[GC] {table}: deleted {n} stale row(s) of {len(keys)}, {max(freed, 0)*page>>10} KiB freed"
+              + (f", file {shrunk*page>>10} KiB smaller" if shrunk else ""))
+    return n
+
+def gc_meta(conn, batch=GC_BATCH, vacuum=0, debug=False):
+    """Delete sync_meta_client rows whose key no client of the live inbounds
+    has any more (removed clients, changed emails, rotated UUIDs), so they
+    stop being loaded every cycle. Returns the rows deleted."""
+    before=int(time.time())
+    # اول meta بعد inbounds: کلاینتی که بینشون اضافه بشه توی لیست stale نیست
+    keys=[k for (k,) in conn.execute("SELECT key FROM sync_meta_client")]
+    live={key_for(sub, iid, email, cid) for iid, _, _, _, clients in load_inbounds(conn) for sub, email, cid, _ in clients}
+    return delete_stale(conn, "sync_meta_client", [k for k in keys if k not in live], before, batch, vacuum, debug)
+
+# --- inotify watch mode (Linux, بدون وابستگی خارجی) ---
+IN_MODIFY = 0x002
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+
+def db_watch_names(db_path):
+    """File names whose changes mean the DB changed (-shm is touched by readers too)"""
+    base = os.path.basename(db_path)
+    return {base, base + "-wal", base + "-journal"}
+
+def inotify_open(db_path, *more):
+    """Non-blocking inotify fd watching the DB directory (and those of more
+    DBs), or None if unavailable"""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if fd < 0: return None
+        for d in {os.path.dirname(os.path.abspath(p)) for p in (db_path,) + more}:
+            if libc.inotify_add_watch(fd, d.encode(), IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE) < 0:
+                os.close(fd); return None
+        return fd
+    except Exception:
+        return None
+
+def read_events(fd, names):
+    """Drain pending inotify events; True if any of them touched one of names"""
+    hit = False
+    while True:
+        try: buf = os.read(fd, 65536)
+        except BlockingIOError: return hit
+        if not buf: return hit
+        i = 0
+        while i + 16 <= len(buf):
+            _wd, _mask, _cookie, ln = struct.unpack_from("iIII", buf, i)
+            name = buf[i+16:i+16+ln].split(b"\0", 1)[0].decode(errors="replace")
+            if name in names: hit = True
+            i += 16 + ln
+
+def wait_for_change(fd, names, timeout, debounce):
+    """Block until the DB files change and then stay quiet for debounce
+    seconds, or until timeout (the max-latency fallback) passes"""
+    deadline = time.monotonic() + timeout
+    while True:
+        left = deadline - time.monotonic()
+        if left <= 0: return False
+        r, _, _ = select.select([fd], [], [], left)
+        if r and read_events(fd, names): break
+    # debounce: نوشتن‌های پشت سر هم x-ui یک چرخه حساب میشن
+    while True:
+        left = min(debounce, deadline - time.monotonic())
+        if left <= 0: return True
+        r, _, _ = select.select([fd], [], [], left)
+        if not r: return True
+        read_events(fd, names)
+
+# --- metrics: Prometheus textfile / localhost HTTP ---
+def prom_label(v):
+    """A Prometheus label value: backslash, double quote and newline escaped"""
+    return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def new_loop_metrics(engines):
+    return {"engines": "+".join(engines), "cycles": 0, "errors": 0, "skipped": 0, "cycle_seconds": 0.0,
+            "overrun_seconds": 0.0, "rows_written": 0, "last_cycle": 0.0, "gc_deleted": 0}
+
+def render_metrics(engine_metrics, loop):
+    """Prometheus text exposition of the last cycle (engine -> metrics dict)"""
+    out=[]
+    def family(name, typ, doc, samples):
+        out.append(f"# HELP winnet_sync_{name} {doc}")
+        out.append(f"# TYPE winnet_sync_{name} {typ}")
+        for labels, v in samples:
+            lab=",".join(f'{k}="{prom_label(val)}"' for k, val in labels.items())
+            out.append(f"winnet_sync_{name}{{{lab}}} {v}")
+    em=[(e, m) for e, m in engine_metrics.items() if m]
+    family("phase_seconds", "gauge", "Time spent in each phase of the last cycle",
+           [({"engine": e, "phase": ph}, f"{v:.6f}") for e, m in em for ph, v in sorted(m["phases"].items())])
+    for key, doc in (("rows_read", "Rows read in the last cycle"),
+                     ("groups_planned", "Groups that went through planning in the last cycle"),
+                     ("plans", "Planned changes in the last cycle"),
+                     ("lock_wait", "Seconds spent waiting for the write lock in the last cycle"),
+                     ("skipped", "1 if the last cycle was skipped because nothing changed")):
+        name=key+"_seconds" if key=="lock_wait" else key
+        family(name, "gauge", doc, [({"engine": e}, m[key]) for e, m in em])
+    lab={"engines": loop["engines"]}
+    family("cycle_seconds", "gauge", "Wall time of the last cycle", [(lab, f"{loop['cycle_seconds']:.6f}")])
+    family("overrun_seconds", "gauge", "How far the last cycle ran past --interval", [(lab, f"{loop['overrun_seconds']:.6f}")])
+    family("rows_written", "gauge", "Rows written in the last cycle", [(lab, loop["rows_written"])])
+    family("cycles_total", "counter", "Cycles run since start", [(lab, loop["cycles"])])
+    family("skipped_total", "counter", "Cycles skipped because nothing changed", [(lab, loop["skipped"])])
+    family("errors_total", "counter", "Cycles that raised", [(lab, loop["errors"])])
+    family("gc_deleted_total", "counter", "Stale meta rows deleted by GC", [(lab, loop["gc_deleted"])])
+    family("last_cycle_timestamp_seconds", "gauge", "Unix time the last cycle finished", [(lab, f"{loop['last_cycle']:.3f}")])
+    return "\n".join(out)+"\n"
+
+def write_textfile(path, text):
+    """Atomic write for node_exporter's textfile collector"""
+    tmp=path+".tmp"
+    with open(tmp, "w") as f: f.write(text)
+    os.replace(tmp, path)
+
+def start_metrics_server(port, holder):
+    """Serve holder["text"] on http://127.0.0.1:port/metrics from a daemon thread"""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path not in ("/", "/metrics"):
+                self.send_error(404); return
+            body=holder.get("text", "").encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        def log_message(self, *a): pass
+    srv=ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    return srv
+
+# --- backups: SQLite online backup API + rotation ---
+def list_backups(db_path, prefix):
+    """Finished backups of db_path named <db><prefix><timestamp>[.gz], oldest
+    first. Only names backup_db() writes match, so a copy made by hand next
+    to them (x-ui.db.bak_before_upgrade, ...) is never rotated away."""
+    d=os.path.dirname(os.path.abspath(db_path))
+    name=re.compile(re.escape(os.path.basename(db_path)+prefix)+r"\d{8}_\d{6}(\.gz)?")
+    out=[os.path.join(d, f) for f in os.listdir(d) if name.fullmatch(f)]
+    return sorted(out, key=os.path.getmtime)
+
+def backup_db(conn, db_path, prefix, compress=False, pages=256, pause=0.005):
+    """Copy the live DB through conn.backup() in steps of `pages` pages,
+    sleeping `pause` between steps so x-ui never waits long on our read
+    lock. Unlike a raw file copy this includes the WAL and is never torn."""
+    ts=datetime.now().strftime("%Y%m%d_%H%M%S")
+    path=f"{db_path}{prefix}{ts}"
+    tmp=path+".part"
+    dst=sqlite3.connect(tmp)
+    try:
+        conn.backup(dst, pages=pages, progress=lambda status, remaining, total: time.sleep(pause))
+    finally:
+        dst.close()
+    if compress:
+        with open(tmp, "rb") as f, gzip.open(path+".gz.part", "wb") as g:
+            shutil.copyfileobj(f, g, 1 << 20)
+        os.remove(tmp)
+        tmp=path+".gz.part"; path+=".gz"
+    os.replace(tmp, path)
+    return path
+
+def rotate_backups(db_path, prefix, keep):
+    """Delete all but the newest `keep` backups (keep<=0 keeps everything)"""
+    if keep<=0: return []
+    old=list_backups(db_path, prefix)[:-keep]
+    for p in old: os.remove(p)
+    return old
+
+def maybe_backup(conn, args, prefix, db=None):
+    """Snapshot before applying when the newest backup is older than
+    --backup-interval, so a restart loop does not pile up full copies.
+    db: path of conn when it is not --db (a --panel database)"""
+    if not (args.apply and args.backup): return None
+    db=db or args.db
+    bak=list_backups(db, prefix)
+    if bak and time.time()-os.path.getmtime(bak[-1]) < args.backup_interval: return None
+    try:
+        path=backup_db(conn, db, prefix, compress=args.backup_compress)
+        removed=rotate_backups(db, prefix, args.backup_keep)
+    except (sqlite3.Error, OSError) as e:
+        print("[ERROR] backup:", e); return None
+    print("[INFO] Backup:", path+(f" (rotated {len(removed)})" if removed else ""))
+    return path
+
 def main():
     ap=argparse.ArgumentParser()
     ap.add_argument("--db", default=DB_DEFAULT)
-    ap.add_argument("--interval", type=int, default=30)
+    ap.add_argument("--interval", type=int, default=30, help="poll interval; with --watch the max-latency fallback")
+    ap.add_argument("--watch", action="store_true", help="run a cycle when x-ui.db / -wal / -journal change (inotify)")
+    ap.add_argument("--debounce", type=float, default=0.5, help="with --watch: wait this long after the last change")
     ap.add_argument("--apply", action="store_true")
-    ap.add_argument("--backup", action="store_true")
+    ap.add_argument("--backup", action="store_true", help="with --apply: online backup before applying")
+    ap.add_argument("--backup-interval", type=int, default=86400, help="seconds between backups (also across restarts)")
+    ap.add_argument("--backup-keep", type=int, default=5, help="backups to keep, 0 = all")
+    ap.add_argument("--backup-compress", action="store_true", help="gzip backups")
     ap.add_argument("--init", action="store_true")
     ap.add_argument("--debug", action="store_true")
+    ap.add_argument("--metrics-file", help="write Prometheus metrics here after every cycle (textfile collector)")
+    ap.add_argument("--metrics-port", type=int, help="serve Prometheus metrics on 127.0.0.1:PORT/metrics")
+    ap.add_argument("--engines", default="client",
+                    help="comma separated: client,tunnel. More than one runs them on one snapshot and writes their changes together")
+    ap.add_argument("--fast-interval", type=float, default=5,
+                    help="between full cycles, re-reconcile groups close to their quota/expiry this often (0 = off, not with --panel)")
+    ap.add_argument("--panel", action="append", default=[], metavar="DB",
+                    help="x-ui.db of another panel (repeatable): subIds are synced across --db and every --panel DB (client engine only)")
+    ap.add_argument("--panel-workers", type=int, default=PANEL_WORKERS, help="with --panel: threads loading and writing the panels")
+    ap.add_argument("--pipeline", action="store_true",
+                    help="client engine: read snapshots on a read-only connection and write on a separate thread, overlapping the two (no fast path)")
+    ap.add_argument("--wal", action="store_true", help="switch the database to WAL so snapshot reads and writes never block each other (persistent)")
+    ap.add_argument("--sql", action="store_true",
+                    help="client engine: find the groups to reconcile inside SQLite (JSON1) instead of scanning every client in Python (no fast path)")
+    ap.add_argument("--gc-interval", type=int, default=GC_INTERVAL,
+                    help="seconds between deletions of meta rows no live client has any more (0 = off)")
+    ap.add_argument("--gc-vacuum", type=int, default=0, metavar="PAGES",
+                    help="after GC, PRAGMA incremental_vacuum up to this many pages (needs auto_vacuum=INCREMENTAL)")
+    ap.add_argument("--plan-workers", type=int, default=0,
+                    help=f"client engine: plan subscription groups on this many processes, hash-partitioned by subId (cycles with {SHARD_MIN}+ clients to plan; not with --panel / --pipeline / --metrics-port)")
     args=ap.parse_args()
 
-    if not os.path.exists(args.db):
-        print("[ERROR] DB not found:", args.db); return
+    dbs=[args.db]+args.panel
+    for db in dbs:
+        if not os.path.exists(db):
+            print("[ERROR] DB not found:", db); return
 
-    if args.apply and args.backup:
-        ts=datetime.now().strftime("%Y%m%d_%H%M%S")
-        shutil.copy2(args.db, f"{args.db}.bak_{ts}")
-        print("[INFO] Backup:", f"{args.db}.bak_{ts}")
+    engines=[e.strip() for e in args.engines.split(",") if e.strip()]
+    bad=[e for e in engines if e not in ENGINES]
+    if bad or not engines:
+        print("[ERROR] unknown engine(s):", ",".join(bad) or args.engines); return
+    if args.panel and engines!=["client"]:
+        print("[ERROR] --panel only works with --engines client"); return
+    if args.sql and (args.panel or engines!=["client"]):
+        print("[ERROR] --sql only works with --engines client and no --panel"); return
+    if args.pipeline and (args.panel or args.sql or engines!=["client"]):
+        print("[ERROR] --pipeline only works with --engines client, without --panel / --sql"); return
+    if args.plan_workers>1 and engines!=["client"]:
+        print("[ERROR] --plan-workers only works with --engines client"); return
+    # fork() از process چندنخی: lock یک نخ دیگه توی فرزند تا ابد قفل می‌مونه
+    if args.plan_workers>1 and (args.panel or args.pipeline or args.metrics_port):
+        print("[ERROR] --plan-workers forks the planner, so it can't run with the threads of --panel / --pipeline / --metrics-port"); return
 
-    conn=sqlite3.connect(args.db, timeout=60, check_same_thread=False)
-    conn.execute("PRAGMA busy_timeout = 3000")  # تنظیم زمان انتظار برای دیتابیس
+    conns=[]
+    for db in dbs:
+        c=sqlite3.connect(db, timeout=60, check_same_thread=False)
+        c.execute("PRAGMA busy_timeout = 3000")  # تنظیم زمان انتظار برای دیتابیس
+        conns.append(c)
+    conn=conns[0]
+    if args.wal:
+        print("[INFO] journal_mode:", conn.execute("PRAGMA journal_mode=WAL").fetchone()[0])
+    pool=None; ro=None; writer=None; planner=None
     try:
+        if not args.init:
+            for c, db in zip(conns, dbs): maybe_backup(c, args, ".bak_", db)
+        if "tunnel" in engines: import sync_inbound_tunnel
         if args.init:
-            ensure_seed(conn, debug=args.debug); return
+            if "client" in engines:
+                for c in conns: ensure_seed(c, debug=args.debug)
+            if "tunnel" in engines: sync_inbound_tunnel.ensure_seed(conn, debug=args.debug)
+            return
+        # مهاجرت schema فقط همین یک بار؛ چرخه‌ها DDL اجرا نمی‌کنن
+        if "client" in engines:
+            for c in conns: ensure_meta(c)
+        if "tunnel" in engines: sync_inbound_tunnel.ensure_meta(conn)
+        if args.plan_workers>1:
+            planner=functools.partial(plan_sharded, shards=args.plan_workers)
+        if args.panel:
+            pool=ThreadPoolExecutor(max_workers=max(1, min(args.panel_workers, len(conns))))
+            print("[INFO] panels:", " ".join(f"{i}={db}" for i, db in enumerate(dbs)))
+            cycle=lambda state: sync_panels(conns, apply=args.apply, debug=args.debug, state=state, pool=pool, planner=planner)
+        elif args.pipeline:
+            ro=open_snapshot(args.db)
+            writer=ThreadPoolExecutor(max_workers=1, thread_name_prefix="winnet-writer")
+            def cycle(state):
+                st=state if state is not None else {}
+                n=sync_pipelined(ro, conn, writer, apply=args.apply, debug=args.debug, state=st, planner=planner)
+                if state is None and st.get("write"): st.pop("write").result()
+                return n
+        elif args.sql and json1_available(conn):
+            cycle=lambda state: sync_once_sql(conn, apply=args.apply, debug=args.debug, state=state, planner=planner)
+        elif engines==["client"]:
+            if args.sql: print("[WARN] SQLite has no JSON1, using the Python planner")
+            cycle=lambda state: sync_once(conn, apply=args.apply, debug=args.debug, state=state, planner=planner)
+        else:
+            cycle=lambda state: run_engines(conn, engines, apply=args.apply, debug=args.debug, states=state)
         if args.interval<=0:
-            sync_once(conn, apply=args.apply, debug=args.debug)
+            cycle(None)
         else:
-            print(f"[INFO] loop interval={args.interval}s apply={args.apply}")
+            print(f"[INFO] loop interval={args.interval}s apply={args.apply} watch={args.watch}")
+            state={}
+            fd=inotify_open(*dbs) if args.watch else None
+            if args.watch and fd is None:
+                print("[WARN] inotify unavailable, falling back to interval polling")
+            names=set().union(*(db_watch_names(db) for db in dbs))
+            loop=new_loop_metrics(engines); holder={}
+            if args.metrics_port: start_metrics_server(args.metrics_port, holder)
+            def run_gc():
+                n=0
+                if "client" in engines:
+                    for c in conns: n+=gc_meta(c, vacuum=args.gc_vacuum, debug=args.debug)
+                if "tunnel" in engines: n+=sync_inbound_tunnel.gc_meta(conn, vacuum=args.gc_vacuum, debug=args.debug)
+                return n
+            next_gc=0.0
             while True:
+                # با --pipeline کانکشن اصلی مال writer‌ه؛ backup از snapshot
+                for c, db in zip(conns, dbs): maybe_backup(ro or c, args, ".bak_", db)
+                t0=time.perf_counter(); tc=sum(c.total_changes for c in conns)
                 try:
-                    sync_once(conn, apply=args.apply, debug=args.debug)
+                    cycle(state)
                 except Exception as e:
+                    loop["errors"]+=1
                     print("[ERROR] iteration:", e)
-                time.sleep(args.interval)
+                dt=time.perf_counter()-t0
+                em={"client": state.get("metrics")} if engines==["client"] else {e: state.get(e, {}).get("metrics") for e in engines}
+                loop["cycles"]+=1; loop["cycle_seconds"]=dt; loop["overrun_seconds"]=max(0.0, dt-args.interval)
+                loop["rows_written"]=sum(c.total_changes for c in conns)-tc; loop["last_cycle"]=time.time()
+                if all(m and m["skipped"] for m in em.values()): loop["skipped"]+=1
+                if args.debug:
+                    phases=" ".join(f"{e}.{ph}={v*1000:.1f}ms" for e, m in em.items() if m for ph, v in m["phases"].items())
+                    print(f"[TIMING] cycle={dt*1000:.1f}ms rows_written={loop['rows_written']} {phases}")
+                # GC ردیف‌های meta بی‌صاحب؛ با --pipeline روی thread writer که کانکشن مال اونه
+                if args.gc_interval>0 and time.monotonic()>=next_gc:
+                    next_gc=time.monotonic()+args.gc_interval
+                    try: loop["gc_deleted"]+=writer.submit(run_gc).result() if writer else run_gc()
+                    except Exception as e: print("[ERROR] gc:", e)
+                if args.metrics_file or args.metrics_port:
+                    holder["text"]=render_metrics(em, loop)
+                    if args.metrics_file:
+                        try: write_textfile(args.metrics_file, holder["text"])
+                        except OSError as e: print("[ERROR] metrics file:", e)
+                # تا چرخه کامل بعدی، گروه‌های داغ هر --fast-interval ثانیه سینک میشن
+                hot_state=None if args.panel or "client" not in engines else state if engines==["client"] else state.get("client")
+                until=time.monotonic()+args.interval
+                while True:
+                    left=until-time.monotonic()
+                    if left<=0: break
+                    fast=args.fast_interval>0 and hot_state is not None and hot_state.get("hot")
+                    step=min(left, args.fast_interval) if fast else left
+                    if fd is not None:
+                        if wait_for_change(fd, names, step, args.debounce): break
+                    else:
+                        time.sleep(step)
+                    if fast and time.monotonic()<until:
+                        try: sync_hot(conn, debug=args.debug, state=hot_state)
+                        except Exception as e: print("[ERROR] fast path:", e)
     finally:
-        conn.close()
+        if pool is not None: pool.shutdown()
+        if writer is not None: writer.shutdown()
+        if ro is not None: ro.close()
+        for c in conns: c.close()
 
 if __name__=="__main__":
     main()
\ No newline at end of file